@@ -0,0 +1,129 @@
+# Score every (word, pos) segment of stacked WN and OX embeddings at once, returning each WN sense's best OX senses
+from collections import defaultdict
+
+import numpy as np
+
+metric_names = ['cosine', 'dot_prod', 'euc_dist']
+max_bucket_elements = 2 ** 24  # Bounds the memory of each batched Gram computation
+
+
+def padded_size(size):
+    # Next power of two, so segments of similar shape share a bucket
+    return 1 << max(int(size) - 1, 0).bit_length()
+
+
+def segment_index(offsets, segments, width, pad):
+    # (len(segments), width) array of the rows in each segment, with pad in place of rows past its end
+    starts = offsets[segments][:, None]
+    local = np.arange(width)[None, :]
+    rows = starts + local
+    return np.where(rows < offsets[segments + 1][:, None], rows, pad)
+
+
+def segment_scores(wn_embeddings, ox_embeddings, wn_offsets, ox_offsets, metrics=metric_names, ox_mask=None, k=1):
+    # Segment s covers WN rows wn_offsets[s]:wn_offsets[s+1] and OX rows ox_offsets[s]:ox_offsets[s+1]. Returns
+    # {metric: (|WN|, k) array} of the OX rows ranked best for each WN row, restricted to OX rows where ox_mask is
+    # true; ties go to the earlier row, as with np.argmax, and ranks past a segment's size are -1
+    wn_offsets = np.asarray(wn_offsets)
+    ox_offsets = np.asarray(ox_offsets)
+    assert len(wn_offsets) == len(ox_offsets)
+    wn_sizes = np.diff(wn_offsets)
+    ox_sizes = np.diff(ox_offsets)
+    if ox_mask is None:
+        ox_mask = np.ones(len(ox_embeddings), dtype=bool)
+
+    # Extra zero row (and false mask entry) for padding to point at
+    wn_padded = np.concatenate([wn_embeddings, np.zeros((1, wn_embeddings.shape[1]))]).astype(np.float64)
+    ox_padded = np.concatenate([ox_embeddings, np.zeros((1, ox_embeddings.shape[1]))]).astype(np.float64)
+    ox_mask_padded = np.append(np.asarray(ox_mask, dtype=bool), False)
+    wn_norms = np.linalg.norm(wn_padded, axis=1)
+    ox_norms = np.linalg.norm(ox_padded, axis=1)
+
+    ranked = {metric: np.full((len(wn_embeddings), k), -1, dtype=np.int64) for metric in metrics}
+
+    buckets = defaultdict(list)
+    for segment, (wn_size, ox_size) in enumerate(zip(wn_sizes, ox_sizes)):
+        if wn_size > 0:
+            buckets[(padded_size(wn_size), padded_size(ox_size))].append(segment)
+
+    for (wn_width, ox_width), segments in buckets.items():
+        segment_elements = wn_width * ox_width + (wn_width + ox_width) * wn_padded.shape[1]
+        chunk_size = max(1, max_bucket_elements // segment_elements)
+        segments = np.array(segments)
+        for start in range(0, len(segments), chunk_size):
+            chunk = segments[start:start + chunk_size]
+            wn_index = segment_index(wn_offsets, chunk, wn_width, len(wn_embeddings))
+            ox_index = segment_index(ox_offsets, chunk, ox_width, len(ox_embeddings))
+            valid = ox_mask_padded[ox_index][:, None, :]
+            if not np.all(valid.any(axis=2)):
+                raise ValueError('A segment has no OX senses to align to')
+
+            # All metrics come from one Gram matrix and the norms
+            gram = np.matmul(wn_padded[wn_index], ox_padded[ox_index].transpose(0, 2, 1))
+            wn_norm = wn_norms[wn_index][:, :, None]
+            ox_norm = ox_norms[ox_index][:, None, :]
+
+            for metric in metrics:
+                if metric == 'dot_prod':
+                    scores = gram
+                elif metric == 'cosine':
+                    scores = gram / (np.maximum(wn_norm, 1e-12) * np.maximum(ox_norm, 1e-12))
+                else:
+                    assert metric == 'euc_dist'
+                    scores = -np.sqrt(np.maximum(wn_norm ** 2 + ox_norm ** 2 - 2 * gram, 0))
+                scores = np.where(valid, scores, -np.inf)
+
+                if k == 1:
+                    best = np.argmax(scores, axis=2)[:, :, None]
+                else:
+                    best = np.argsort(-scores, axis=2, kind='stable')[:, :, :k]
+                best_valid = np.take_along_axis(np.broadcast_to(valid, scores.shape), best, axis=2)
+                best_rows = np.where(best_valid, ox_offsets[chunk][:, None, None] + best, -1)
+
+                # Write back the rows of real WN senses
+                real = wn_index < len(wn_embeddings)
+                ranked[metric][wn_index[real], :best_rows.shape[2]] = best_rows[real]
+
+    return ranked
+
+
+def segment_pairs(wn_offsets, ox_offsets, ox_mask=None):
+    # Every (WN row, OX row) pair within the same segment, ordered by WN row then OX row
+    wn_offsets = np.asarray(wn_offsets)
+    ox_offsets = np.asarray(ox_offsets)
+    wn_sizes = np.diff(wn_offsets)
+    ox_sizes = np.diff(ox_offsets)
+    pair_counts = wn_sizes * ox_sizes
+    pair_segments = np.repeat(np.arange(len(pair_counts)), pair_counts)
+    local = np.arange(pair_counts.sum()) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    pair_ox_sizes = ox_sizes[pair_segments]
+    pair_wn = wn_offsets[pair_segments] + local // pair_ox_sizes
+    pair_ox = ox_offsets[pair_segments] + local % pair_ox_sizes
+    if ox_mask is not None:
+        keep = np.asarray(ox_mask, dtype=bool)[pair_ox]
+        pair_wn, pair_ox = pair_wn[keep], pair_ox[keep]
+    return pair_wn, pair_ox
+
+
+def pair_argmax(pair_wn, pair_ox, scores, num_wn):
+    # Best OX row for each WN row from scored pairs, with ties going to the earlier OX row as with np.argmax
+    if len(np.unique(pair_wn)) != num_wn:
+        raise ValueError('A segment has no OX senses to align to')
+    order = np.lexsort((pair_ox, -scores, pair_wn))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = pair_wn[order][1:] != pair_wn[order][:-1]
+    best = np.full(num_wn, -1, dtype=np.int64)
+    best[pair_wn[order][first]] = pair_ox[order][first]
+    return best
+
+
+def segment_offsets(segments):
+    offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(segment) for segment in segments])
+    return offsets
+
+
+def stack_segments(segments):
+    # [[rows of segment 0], [rows of segment 1], ...] -> (concatenated rows, offsets)
+    rows = np.array([row for segment in segments for row in segment], dtype=np.int64)
+    return rows, segment_offsets(segments)
@@ -0,0 +1,34 @@
+# Coarsen many groups of lemmas at once; mixed into the coarseners
+from multiprocessing import get_context
+
+from src.common import info
+
+worker_coarsener = None
+
+
+def coarsen_chunk(groups):
+    return [worker_coarsener.coarsen_homographs(list(group)) for group in groups]
+
+
+class BatchCoarsener:
+
+    def coarsen_many(self, lemma_groups, workers=1, chunk_size=1000):
+        # Returns coarsen_homographs(group) for each group. Groups with the same lemmas are only coarsened once,
+        # and lemmas are resolved once across all groups. With workers > 1 the unique groups are split across
+        # forked processes, which share this coarsener (so any missing lemmas should be prefetched first)
+        global worker_coarsener
+
+        unique_groups = sorted({tuple(sorted(set(group))) for group in lemma_groups})
+        info(f'Coarsening {len(lemma_groups)} groups ({len(unique_groups)} unique) with {workers} worker(s)')
+
+        if workers == 1:
+            unique_clusters = [self.coarsen_homographs(list(group)) for group in unique_groups]
+        else:
+            chunks = [unique_groups[i:i + chunk_size] for i in range(0, len(unique_groups), chunk_size)]
+            worker_coarsener = self
+            with get_context('fork').Pool(workers) as pool:
+                unique_clusters = [clusters for chunk in pool.imap(coarsen_chunk, chunks) for clusters in chunk]
+            worker_coarsener = None
+
+        group_names = {group: dict(zip(group, clusters)) for group, clusters in zip(unique_groups, unique_clusters)}
+        return [[group_names[tuple(sorted(set(group)))][lemma] for lemma in group] for group in lemma_groups]
@@ -0,0 +1,287 @@
+# Columnar form of the wordnet and oxford dictionaries, memory-mapped from a directory: interned values in integer-coded
+# columns, with each (word, pos) owning a range of rows. Reads like the nested {(word, pos): {sense_id: sense}} dicts it
+# replaces, decoding senses only when a key is accessed
+import os
+import pickle
+from collections.abc import Mapping
+from itertools import repeat
+
+import numpy as np
+
+from src.common import info, open_pickle, save_pickle
+from src.mapped_files import save_array, load_array, save_table, Table, search_sorted, replace_directory, \
+    legacy_pickle
+
+missing = -1  # Code of a field the sense does not have
+same_as_id = -2  # Code of a field equal to the sense id
+scan_block_size = 10000  # Keys decoded together by a full scan
+
+
+def freeze(value):
+    # Hashable version of a sense's field, tagged with the container types to rebuild
+    if isinstance(value, dict):
+        return dict, tuple((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, set):
+        return set, frozenset(freeze(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    if isinstance(value, tuple):
+        container, items = value
+        if container is dict:
+            return {key: thaw(item) for key, item in items}
+        return container(thaw(item) for item in items)
+    return value
+
+
+class Interner:
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        if value not in self.codes:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+        return self.codes[value]
+
+
+def save_dictionary(directory, nested_dict):
+    words = Interner()
+    poses = Interner()
+    stems = Interner()  # Sense ids without their ':word:pos' suffix
+    field_values = {}  # field -> Interner
+    field_codes = {}  # field -> list of codes, one per row
+
+    key_words = []
+    key_poses = []
+    offsets = [0]
+    sense_stems = []
+    suffixed = []
+    for key_count, ((word, pos), senses) in enumerate(nested_dict.items()):
+        if key_count % 10000 == 0:
+            info(f'Columnising {key_count}/{len(nested_dict)}')
+        key_words.append(words.code(word))
+        key_poses.append(poses.code(pos))
+        suffix = f':{word}:{pos}'
+        for sense_id, sense in senses.items():
+            row = len(sense_stems)
+            if sense_id.endswith(suffix):
+                sense_stems.append(stems.code(sense_id[:-len(suffix)]))
+                suffixed.append(True)
+            else:
+                sense_stems.append(stems.code(sense_id))
+                suffixed.append(False)
+
+            for field, value in sense.items():
+                if field not in field_codes:
+                    field_values[field] = Interner()
+                    field_codes[field] = [missing] * row
+                if value == sense_id:
+                    field_codes[field].append(same_as_id)
+                else:
+                    field_codes[field].append(field_values[field].code(freeze(value)))
+            for field, codes in field_codes.items():
+                if len(codes) == row:
+                    codes.append(missing)
+        offsets.append(len(sense_stems))
+
+    # Keys in sorted order, for looking them up without an index
+    key_order = sorted(range(len(key_words)), key=lambda k: (words.values[key_words[k]], poses.values[key_poses[k]]))
+    fields = list(field_codes.keys())
+
+    def write(temporary):
+        save_table(temporary, 'words', words.values)
+        save_table(temporary, 'poses', poses.values)
+        save_table(temporary, 'stems', stems.values)
+        save_array(temporary, 'key_words', np.array(key_words, dtype=np.int32))
+        save_array(temporary, 'key_poses', np.array(key_poses, dtype=np.int32))
+        save_array(temporary, 'key_order', np.array(key_order, dtype=np.int32))
+        save_array(temporary, 'offsets', np.array(offsets, dtype=np.int64))
+        save_array(temporary, 'sense_stems', np.array(sense_stems, dtype=np.int32))
+        save_array(temporary, 'suffixed', np.array(suffixed, dtype=bool))
+        for i, field in enumerate(fields):
+            save_table(temporary, f'values_{i}', [thaw(value) for value in field_values[field].values])
+            save_array(temporary, f'codes_{i}', np.array(field_codes[field], dtype=np.int32))
+        save_pickle(os.path.join(temporary, 'meta.pkl'), {'fields': fields})
+
+    replace_directory(directory, write)
+    info(f'Saved {len(key_words)} keys and {len(sense_stems)} senses to {directory}')
+
+
+class SenseView(Mapping):
+    # The senses of one (word, pos); every access builds fresh sense dicts
+
+    def __init__(self, dictionary, key, start, end):
+        self.dictionary = dictionary
+        self.key = key
+        self.start = start
+        self.end = end
+        self.row_lookup = None
+
+    def sense_ids(self):
+        return self.dictionary.sense_ids(self.key, self.start, self.end)
+
+    def __getitem__(self, sense_id):
+        if self.row_lookup is None:
+            self.row_lookup = {sense_id: row for row, sense_id in enumerate(self.sense_ids(), self.start)}
+        row = self.row_lookup[sense_id]
+        return self.dictionary.senses(self.key, row, row + 1)[0]
+
+    def __iter__(self):
+        return iter(self.sense_ids())
+
+    def __len__(self):
+        return self.end - self.start
+
+    def values(self):
+        return self.dictionary.senses(self.key, self.start, self.end)
+
+    def items(self):
+        return list(zip(self.sense_ids(), self.values()))
+
+
+class ColumnarDictionary(Mapping):
+
+    def __init__(self, directory):
+        directory = os.path.realpath(directory)  # Resolved once, so every file comes from the same version
+        self.words = Table(directory, 'words')
+        self.poses = Table(directory, 'poses')
+        self.stems = Table(directory, 'stems')
+        for name in ['key_words', 'key_poses', 'key_order', 'offsets', 'sense_stems', 'suffixed']:
+            setattr(self, name, load_array(directory, name))
+        self.fields = open_pickle(os.path.join(directory, 'meta.pkl'))['fields']
+        self.field_values = [Table(directory, f'values_{i}') for i in range(len(self.fields))]
+        self.field_codes = [load_array(directory, f'codes_{i}') for i in range(len(self.fields))]
+        self.key_index = None  # Built by the first full pass over the keys
+
+    def key_at(self, k):
+        return self.words[self.key_words[k]], self.poses[self.key_poses[k]]
+
+    def find(self, key):
+        if self.key_index is not None:
+            return self.key_index.get(key)
+        position = search_sorted(len(self.key_order), key, lambda i: self.key_at(self.key_order[i]))
+        return None if position is None else int(self.key_order[position])
+
+    def sense_ids(self, key, start, end):
+        suffix = ':{}:{}'.format(*key)
+        return [self.stems[stem] + suffix if suffixed else self.stems[stem]
+                for stem, suffixed in zip(self.sense_stems[start:end].tolist(), self.suffixed[start:end].tolist())]
+
+    def senses(self, key, start, end):
+        sense_ids = self.sense_ids(key, start, end)
+        senses = [{} for _ in sense_ids]
+        for field, values, codes in zip(self.fields, self.field_values, self.field_codes):
+            for sense_id, sense, code in zip(sense_ids, senses, codes[start:end].tolist()):
+                if code == same_as_id:
+                    sense[field] = sense_id
+                elif code != missing:
+                    sense[field] = values[code]
+        return senses
+
+    def __getitem__(self, key):
+        # Like the defaultdict(dict) this replaces, a missing (word, pos) has no senses
+        k = self.find(key)
+        if k is None:
+            return SenseView(self, key, 0, 0)
+        return SenseView(self, key, int(self.offsets[k]), int(self.offsets[k + 1]))
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def __iter__(self):
+        if self.key_index is None:
+            self.key_index = {self.key_at(k): k for k in range(len(self.key_words))}
+        return iter(self.key_index)
+
+    def __len__(self):
+        return len(self.key_words)
+
+    def items(self):
+        # Every (key, {sense_id: sense}) in one pass, decoding each table once and each block of keys column by column
+        # rather than sense by sense. Mutable values are still decoded once per sense, so no two senses share one
+        words = self.words.decode_all()[0]
+        poses = self.poses.decode_all()[0]
+        stems = self.stems.decode_all()[0]
+        absent = object()
+        tables = []
+        for values, mutable in (table.decode_all() for table in self.field_values):
+            # Codes index the values, with same_as_id and missing landing on the two markers at the end
+            tables.append((values + [same_as_id, absent], mutable, np.array(list(mutable.keys()), dtype=np.int32)))
+        offsets = self.offsets.tolist()
+
+        for block_start in range(0, len(self), scan_block_size):
+            block_end = min(block_start + scan_block_size, len(self))
+            keys = [(words[word], poses[pos]) for word, pos in zip(self.key_words[block_start:block_end].tolist(),
+                                                                   self.key_poses[block_start:block_end].tolist())]
+            first_row, last_row = offsets[block_start], offsets[block_end]
+            sizes = np.diff(self.offsets[block_start:block_end + 1])
+            row_suffixes = [':{}:{}'.format(*keys[k]) for k in np.repeat(np.arange(len(keys)), sizes).tolist()]
+            sense_ids = [stems[stem] + suffix if suffixed else stems[stem] for stem, suffixed, suffix in
+                         zip(self.sense_stems[first_row:last_row].tolist(), self.suffixed[first_row:last_row].tolist(),
+                             row_suffixes)]
+
+            columns = []
+            for (lookup, mutable, mutable_codes), codes in zip(tables, self.field_codes):
+                codes = codes[first_row:last_row]
+                if np.all(codes == same_as_id):
+                    columns.append(sense_ids)
+                    continue
+                column = list(map(lookup.__getitem__, codes.tolist()))
+                if np.any(codes == same_as_id):
+                    column = [sense_id if code == same_as_id else value
+                              for sense_id, code, value in zip(sense_ids, codes.tolist(), column)]
+                for row in np.flatnonzero(np.isin(codes, mutable_codes)).tolist():
+                    column[row] = pickle.loads(mutable[int(codes[row])])
+                columns.append(column)
+            if len(columns) == 0:
+                senses = [{} for _ in sense_ids]
+            else:
+                senses = list(map(dict, map(zip, repeat(self.fields), zip(*columns))))
+            for field, codes in zip(self.fields, self.field_codes):
+                for row in np.flatnonzero(codes[first_row:last_row] == missing).tolist():
+                    del senses[row][field]
+
+            for k, key in enumerate(keys):
+                start = offsets[block_start + k] - first_row
+                end = offsets[block_start + k + 1] - first_row
+                yield key, dict(zip(sense_ids[start:end], senses[start:end]))
+
+    def values(self):
+        return (senses for _, senses in self.items())
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+def load_dictionary(directory):
+    # Dictionaries pickled as nested dicts are converted the first time they are loaded
+    if not os.path.exists(directory):
+        info(f'Converting {legacy_pickle(directory)} to {directory}')
+        save_dictionary(directory, open_pickle(legacy_pickle(directory)))
+    return ColumnarDictionary(directory)
+
+
+# Convert dictionaries pickled as nested dicts, checking they read back the same
+if __name__ == "__main__":
+    import time
+    from src.global_variables import wn_dictionary_dir, ox_dictionary_dir, ox_lemma_info_dir
+    from src.mapped_files import save_lemma_info, LemmaInfo
+
+    for directory in [wn_dictionary_dir, ox_dictionary_dir]:
+        nested_dict = open_pickle(legacy_pickle(directory))
+        save_dictionary(directory, nested_dict)
+        start = time.time()
+        dictionary = load_dictionary(directory)
+        info(f'Opened {directory} in {time.time() - start:.3f}s')
+        assert dictionary.to_dict() == dict(nested_dict)
+
+    lemma_info = open_pickle(legacy_pickle(ox_lemma_info_dir))
+    save_lemma_info(ox_lemma_info_dir, lemma_info)
+    assert dict(LemmaInfo(ox_lemma_info_dir).items()) == dict(lemma_info)
+    info('Done')
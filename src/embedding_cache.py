@@ -0,0 +1,176 @@
+# Persistent cache of sentence embeddings, keyed by model and a hash of the normalised text
+import fcntl
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+from src.common import info, warn
+from src.global_variables import embedding_cache_dir, embedding_cache_max_entries
+
+empty_key = b''
+
+
+def text_key(text):
+    normalised = ' '.join(text.split())
+    return hashlib.sha1(normalised.encode('utf-8')).hexdigest().encode('ascii')
+
+
+class EmbeddingCache:
+    # Vectors live in a memory-mapped .npy array with a parallel array of text keys, so a row is only trusted if
+    # its key matches. The index (key -> row, last use) is rewritten on save. One process writes at a time; any
+    # other process opening the same model's cache reads from it but does not add to it
+
+    def __init__(self, model_name, cache_dir=embedding_cache_dir, max_entries=embedding_cache_max_entries):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.dir = os.path.join(cache_dir, model_name.replace('/', '__'))
+        self.vectors_file = os.path.join(self.dir, 'vectors.npy')
+        self.keys_file = os.path.join(self.dir, 'keys.npy')
+        self.index_file = os.path.join(self.dir, 'index.pkl')
+        os.makedirs(self.dir, exist_ok=True)
+
+        self.lock_fp = open(os.path.join(self.dir, 'lock'), 'w')
+        try:
+            fcntl.flock(self.lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.writable = True
+        except BlockingIOError:
+            warn(f'Embedding cache for {model_name} is in use elsewhere; opening it read only')
+            self.writable = False
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.tick = 0
+
+        self.index = {}  # key -> [row, last used tick]
+        self.free = []
+        self.vectors = None
+        self.keys = None
+        self.dim = None
+        if os.path.exists(self.index_file) and os.path.exists(self.vectors_file) and os.path.exists(self.keys_file):
+            mode = 'r+' if self.writable else 'r'
+            self.vectors = np.load(self.vectors_file, mmap_mode=mode)
+            self.keys = np.load(self.keys_file, mmap_mode=mode)
+            with open(self.index_file, 'rb') as fp:
+                self.index, self.tick = pickle.load(fp)
+            rows = min(len(self.vectors), len(self.keys))
+            self.index = {key: entry for key, entry in self.index.items() if entry[0] < rows}
+            used = {row for row, _ in self.index.values()}
+            self.free = [row for row in range(rows) if row not in used]
+            self.dim = self.vectors.shape[1]
+
+    def _lookup(self, key):
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        row = entry[0]
+        # Check the key either side of the read, so a row being rewritten by the writer is never returned
+        if self.keys[row] != key:
+            return None
+        vector = np.array(self.vectors[row])
+        if self.keys[row] != key:
+            return None
+        entry[1] = self.tick
+        return vector
+
+    def _take_rows(self, number):
+        # Unused rows first, then grow the arrays up to max_entries, then evict the least recently used entries.
+        # Entries used by the current call are never evicted, so fewer than number rows may be returned
+        capacity = 0 if self.vectors is None else len(self.vectors)
+        if len(self.free) < number and capacity < self.max_entries:
+            self._grow(min(self.max_entries, max(2 * capacity, capacity + number - len(self.free), 1024)))
+            self.free.extend(range(capacity, len(self.vectors)))
+        if len(self.free) < number:
+            stale = sorted((last_used, key) for key, (_, last_used) in self.index.items() if last_used < self.tick)
+            for _, key in stale[:number - len(self.free)]:
+                self.free.append(self.index.pop(key)[0])
+                self.evictions += 1
+        rows = self.free[:number]
+        del self.free[:number]
+        return rows
+
+    def _grow(self, capacity):
+        vectors = np.lib.format.open_memmap(self.vectors_file + '.tmp', mode='w+', dtype=np.float32,
+                                            shape=(capacity, self.dim))
+        keys = np.lib.format.open_memmap(self.keys_file + '.tmp', mode='w+', dtype='S40', shape=(capacity,))
+        if self.vectors is not None:
+            vectors[:len(self.vectors)] = self.vectors
+            keys[:len(self.keys)] = self.keys
+        vectors.flush()
+        keys.flush()
+        os.replace(self.vectors_file + '.tmp', self.vectors_file)
+        os.replace(self.keys_file + '.tmp', self.keys_file)
+        self.vectors = vectors
+        self.keys = keys
+
+    def _store(self, keys, vectors):
+        for row, key, vector in zip(self._take_rows(len(keys)), keys, vectors):
+            self.keys[row] = empty_key
+            self.vectors[row] = vector
+            self.keys[row] = key
+            self.index[key] = [row, self.tick]
+
+    def encode(self, model, texts, **kwargs):
+        # Embeds texts with model.encode, only passing it the texts not already cached
+        self.tick += 1
+        text_keys = [text_key(text) for text in texts]
+        found = {}
+        missing = {}
+        for text, key in zip(texts, text_keys):
+            if key in found or key in missing:
+                continue
+            vector = None if self.vectors is None else self._lookup(key)
+            if vector is None:
+                missing[key] = text
+            else:
+                found[key] = vector
+        self.hits += len(found)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            embeddings = np.asarray(model.encode(list(missing.values()), **kwargs), dtype=np.float32)
+            self.dim = embeddings.shape[1]
+            for key, vector in zip(missing.keys(), embeddings):
+                found[key] = vector
+            if self.writable:
+                self._store(list(missing.keys()), embeddings)
+
+        if len(texts) == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        return np.stack([found[key] for key in text_keys])
+
+    def encode_corpus(self, model, texts, chunk_size=10000, **kwargs):
+        # Embeds every unique text once, in chunks of similar length (so model batches carry little padding),
+        # checkpointing the cache after each chunk. Returns the embedding matrix and each text's row in it
+        unique_texts = sorted(set(texts), key=lambda text: (len(text), text))
+        rows = {text: row for row, text in enumerate(unique_texts)}
+        chunks = []
+        for start in range(0, len(unique_texts), chunk_size):
+            info(f'Encoding definitions {start + 1}-{min(start + chunk_size, len(unique_texts))}/{len(unique_texts)}')
+            chunks.append(self.encode(model, unique_texts[start:start + chunk_size], **kwargs))
+            self.save()
+        if len(chunks) == 0:
+            return np.zeros((0, self.dim or 0), dtype=np.float32), rows
+        return np.concatenate(chunks), rows
+
+    def stats(self):
+        return f'{self.model_name} embedding cache: {self.hits} hits, {self.misses} misses, ' \
+               f'{self.evictions} evictions, {len(self.index)} stored'
+
+    def save(self):
+        info(self.stats())
+        if not self.writable or self.vectors is None:
+            return
+        self.vectors.flush()
+        self.keys.flush()
+        with open(self.index_file + '.tmp', 'wb') as fp:
+            pickle.dump((self.index, self.tick), fp)
+        os.replace(self.index_file + '.tmp', self.index_file)
+
+    def close(self):
+        self.save()
+        self.vectors = None
+        self.keys = None
+        self.lock_fp.close()
@@ -0,0 +1,142 @@
+# Compiled etymology graph: every lemma's resolved root etymologies as interned, sorted integer arrays
+import os
+from collections import defaultdict
+
+import numpy as np
+
+from src.batch_coarsening import BatchCoarsener
+from src.common import info, open_pickle, save_pickle
+from src.global_variables import etymology_graph_dir, ox_lemma_info_dir
+from src.homograph_coarsener_v2 import HomographCoarsenerV2, UnionFind
+from src.mapped_files import directory_signature
+
+array_names = ['lemma_ids', 'root_offsets', 'roots', 'prefix_offsets', 'prefixes', 'skip']
+
+
+def concatenate(int_sets):
+    offsets = np.zeros(len(int_sets) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(int_set) for int_set in int_sets])
+    values = np.array([value for int_set in int_sets for value in sorted(int_set)], dtype=np.int32)
+    return offsets, values
+
+
+def compile_graph(hc, graph_dir=etymology_graph_dir):
+    # Resolve every lemma once with hc and write the interned result to graph_dir
+    lemma_ids = sorted(hc.lemma_info.keys())
+    hc.prefetch(lemma_ids)
+
+    etymology_ids = {}  # etymology tuple -> interned id
+    lemma_roots = []
+    skip = np.zeros(len(lemma_ids), dtype=bool)
+    for i, lemma_id in enumerate(lemma_ids):
+        if i % 10000 == 0:
+            info(f'Resolving lemma {i}/{len(lemma_ids)}')
+        etymology, _, skip[i] = hc.resolve(lemma_id)
+        roots = set()
+        for chain in etymology:
+            assert len(chain) > 0
+            roots.add(etymology_ids.setdefault(chain, len(etymology_ids)))
+        lemma_roots.append(roots)
+
+    # The interned chains that are prefixes of each chain (itself included)
+    chain_prefixes = {}
+    for chain, chain_id in etymology_ids.items():
+        chain_prefixes[chain_id] = {etymology_ids[chain[:length]] for length in range(1, len(chain) + 1)
+                                    if chain[:length] in etymology_ids}
+    lemma_prefixes = [set().union(*[chain_prefixes[root] for root in roots]) for roots in lemma_roots]
+
+    root_offsets, roots = concatenate(lemma_roots)
+    prefix_offsets, prefixes = concatenate(lemma_prefixes)
+    arrays = {
+        'lemma_ids': np.array(lemma_ids),
+        'root_offsets': root_offsets,
+        'roots': roots,
+        'prefix_offsets': prefix_offsets,
+        'prefixes': prefixes,
+        'skip': skip
+    }
+
+    os.makedirs(graph_dir, exist_ok=True)
+    hc.save()  # Prefetching may have added lemmas
+    for name, array in arrays.items():
+        np.save(os.path.join(graph_dir, f'{name}.npy'), array)
+    etymologies = sorted(etymology_ids, key=etymology_ids.get)
+    save_pickle(os.path.join(graph_dir, 'meta.pkl'), (directory_signature(ox_lemma_info_dir), etymologies))
+    info(f'Compiled {len(lemma_ids)} lemmas over {len(etymologies)} etymologies')
+
+
+def is_compiled(graph_dir=etymology_graph_dir):
+    meta_file = os.path.join(graph_dir, 'meta.pkl')
+    return os.path.exists(meta_file) and open_pickle(meta_file)[0] == directory_signature(ox_lemma_info_dir)
+
+
+class EtymologyGraph(BatchCoarsener):
+    # Read-only and memory-mapped, so worker processes share one copy
+
+    def __init__(self, graph_dir=etymology_graph_dir):
+        for name in array_names:
+            setattr(self, name, np.load(os.path.join(graph_dir, f'{name}.npy'), mmap_mode='r'))
+        _, self.etymologies = open_pickle(os.path.join(graph_dir, 'meta.pkl'))
+        self.index = {lemma_id: i for i, lemma_id in enumerate(self.lemma_ids.tolist())}
+
+    def roots_of(self, i):
+        return self.roots[self.root_offsets[i]:self.root_offsets[i + 1]]
+
+    def prefixes_of(self, i):
+        return self.prefixes[self.prefix_offsets[i]:self.prefix_offsets[i + 1]]
+
+    def merge_indices(self, indices):
+        # Same components as merge_lemmas: lemmas are joined when a root of one is a prefix of a root of another
+        union_find = UnionFind(len(indices))
+        owners = {}
+        for position, i in enumerate(indices):
+            for root in self.roots_of(i).tolist():
+                if root in owners:
+                    union_find.union(owners[root], position)
+                else:
+                    owners[root] = position
+        for position, i in enumerate(indices):
+            for prefix in self.prefixes_of(i).tolist():
+                if prefix in owners:
+                    union_find.union(owners[prefix], position)
+        return [union_find.find(position) for position in range(len(indices))]
+
+    def coarsen_homographs(self, lemmas_codes, warn_cycles=False):
+        lemmas = sorted(set(lemmas_codes))
+        indices = [self.index[lemma] for lemma in lemmas]
+
+        # If one is excluded, exclude all
+        if any(self.skip[i] for i in indices):
+            return ['exclude'] * len(lemmas_codes)
+
+        root_to_lemmas = defaultdict(list)
+        for lemma, root in zip(lemmas, self.merge_indices(indices)):
+            root_to_lemmas[root].append(lemma)
+        lemma_to_name = {}
+        for cluster_lemmas in root_to_lemmas.values():
+            name = '/'.join(cluster_lemmas)
+            for lemma in cluster_lemmas:
+                lemma_to_name[lemma] = name
+
+        return [lemma_to_name[lemma] for lemma in lemmas_codes]
+
+    def prefetch(self, coarse_ids):
+        # Everything was resolved when compiling
+        pass
+
+    def save(self):
+        info('Etymology graph is read only; nothing to save')
+
+
+def load_coarsener(missing_lemmas='fetch'):
+    # The compiled graph if it is up to date with the lemma info, otherwise a coarsener resolving lemmas as it goes
+    if is_compiled():
+        info('Using compiled etymology graph')
+        return EtymologyGraph()
+    info("No up to date etymology graph; run python -m src.etymology_graph (the runner's graph stage) to compile one")
+    return HomographCoarsenerV2(missing_lemmas=missing_lemmas)
+
+
+# Compile the graph
+if __name__ == "__main__":
+    compile_graph(HomographCoarsenerV2(memo_file=None))
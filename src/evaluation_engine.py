@@ -0,0 +1,166 @@
+# Scores the predictions of many models at once against integer-coded gold labels split into segments (test words).
+# Gives micro (mean over segments) and macro (all items pooled) accuracy, weighted F1 and AMI, each as sklearn's
+# accuracy_score, f1_score(average='weighted') and adjusted_mutual_info_score compute them, from the contingency
+# counts of every (model, segment, gold label, predicted label)
+import numpy as np
+from scipy.special import gammaln
+
+from src.common import info
+
+eps = np.finfo(np.float64).eps
+
+
+def encode_labels(label_lists, codes):
+    # Integer codes for the labels of each list, added to codes as they are first seen
+    return [np.array([codes.setdefault(label, len(codes)) for label in labels], dtype=np.int64)
+            for labels in label_lists]
+
+
+def expected_mutual_information(a, b, n):
+    # EMI of two labellings of n items with cluster sizes a and b, summed over every feasible overlap n_ij at once.
+    # Cells only depend on their row and column sizes, so each distinct pair of sizes is summed once, weighted by
+    # how many cells have it
+    a, a_counts = np.unique(a, return_counts=True)
+    b, b_counts = np.unique(b, return_counts=True)
+    weights = np.outer(a_counts, b_counts).ravel()
+    a = np.repeat(a, len(b))
+    b = np.tile(b, len(a) // len(b))
+    start = np.maximum(1, a - n + b)
+    lengths = np.maximum(np.minimum(a, b) + 1 - start, 0)
+    cell = np.repeat(np.arange(len(a)), lengths)
+    nij = start[cell] + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    a = a[cell]
+    b = b[cell]
+    term1 = nij / n
+    term2 = np.log(n) + np.log(nij) - np.log(a) - np.log(b)
+    gln = (gammaln(a + 1) + gammaln(b + 1) + gammaln(n - a + 1) + gammaln(n - b + 1) - gammaln(nij + 1) -
+           gammaln(n + 1) - gammaln(a - nij + 1) - gammaln(b - nij + 1) - gammaln(n - a - b + nij + 1))
+    return float(np.sum(weights[cell] * term1 * term2 * np.exp(gln)))
+
+
+def entropies(counts, groups, n_groups, sizes):
+    # Entropy of each group's labelling, from the non-zero count of each label in it
+    terms = counts / sizes[groups] * (np.log(counts) - np.log(sizes[groups]))
+    return -np.bincount(groups, weights=terms, minlength=n_groups)
+
+
+class SegmentedLabels:
+
+    def __init__(self, gold, offsets):
+        # gold holds the label code of every item, with segment s covering gold[offsets[s]:offsets[s + 1]]
+        self.gold = np.asarray(gold, dtype=np.int64)
+        self.sizes = np.diff(offsets)
+        assert np.all(self.sizes > 0), 'Every segment needs at least one item'
+        self.segments = np.repeat(np.arange(len(self.sizes)), self.sizes)
+        self.emi_memo = {}  # (n, gold cluster sizes, predicted cluster sizes) -> EMI; words repeat across models
+
+    def segment_scores(self, predictions, segments, sizes):
+        # Each metric for each model (row of predictions) and segment
+        n_models, n_items = predictions.shape
+        n_segments = len(sizes)
+        n_labels = int(max(self.gold.max(), predictions.max())) + 1
+        rows = np.arange(n_models)[:, None]
+        matches = predictions == self.gold[None, :]
+
+        # Dense ids of the (segment, label) pairs occurring as gold or predicted labels
+        pairs, pair_ids = np.unique(np.concatenate([segments * n_labels + self.gold,
+                                                    (segments[None, :] * n_labels + predictions).ravel()]),
+                                    return_inverse=True)
+        n_pairs = len(pairs)
+        pair_segments = pairs // n_labels
+        gold_ids = pair_ids[:n_items]
+        pred_ids = pair_ids[n_items:].reshape(n_models, n_items)
+
+        support = np.bincount(gold_ids, minlength=n_pairs)
+        predicted = np.bincount((rows * n_pairs + pred_ids).ravel(),
+                                minlength=n_models * n_pairs).reshape(n_models, n_pairs)
+        true_positives = np.bincount((rows * n_pairs + gold_ids[None, :])[matches],
+                                     minlength=n_models * n_pairs).reshape(n_models, n_pairs)
+        model_segments = (rows * n_segments + segments[None, :]).ravel()
+        n_model_segments = n_models * n_segments
+        scores = {}
+
+        scores['acc'] = np.bincount(model_segments, weights=matches.ravel(), minlength=n_model_segments)
+        scores['acc'] = scores['acc'].reshape(n_models, n_segments) / sizes[None, :]
+
+        # Weighted F1 of a segment is sum_l support_l * 2 tp_l / (support_l + predicted_l) / size, over gold labels
+        labels = np.flatnonzero(support)
+        f1 = 2 * true_positives[:, labels] / (support[labels] + predicted[:, labels]) * support[labels]
+        scores['f1'] = np.bincount((rows * n_segments + pair_segments[labels][None, :]).ravel(), weights=f1.ravel(),
+                                   minlength=n_model_segments).reshape(n_models, n_segments) / sizes[None, :]
+
+        # Mutual information, summed over the non-zero cells of each contingency table
+        cells, cell_counts = np.unique((rows * n_pairs + gold_ids[None, :]) * n_pairs + pred_ids, return_counts=True)
+        cell_models = cells // (n_pairs * n_pairs)
+        cell_gold = (cells // n_pairs) % n_pairs
+        cell_pred = cells % n_pairs
+        cell_groups = cell_models * n_segments + pair_segments[cell_gold]
+        n = sizes[pair_segments[cell_gold]].astype(np.float64)
+        outer = support[cell_gold] * predicted[cell_models, cell_pred]
+        mi = cell_counts / n * (np.log(cell_counts) - np.log(n)) + cell_counts / n * (-np.log(outer) + 2 * np.log(n))
+        mi = np.where(np.abs(mi) < eps, 0.0, mi)
+        mi = np.clip(np.bincount(cell_groups, weights=mi, minlength=n_model_segments), 0.0, None)
+
+        # Cluster sizes of each segment's gold labelling, and of each model's labelling of it
+        n_classes = np.bincount(pair_segments[labels], minlength=n_segments)
+        class_sizes = np.split(support[labels], np.cumsum(n_classes)[:-1])
+        h_true = entropies(support[labels], pair_segments[labels], n_segments, sizes)
+        pred_models, pred_pairs = np.nonzero(predicted)
+        pred_groups = pred_models * n_segments + pair_segments[pred_pairs]
+        n_clusters = np.bincount(pred_groups, minlength=n_model_segments)
+        cluster_sizes = np.split(predicted[pred_models, pred_pairs], np.cumsum(n_clusters)[:-1])
+        h_pred = entropies(predicted[pred_models, pred_pairs], pred_groups, n_model_segments, np.tile(sizes, n_models))
+
+        emi = np.zeros(n_model_segments)
+        for group in np.flatnonzero((np.tile(n_classes, n_models) > 1) & (n_clusters > 1)):
+            segment = group % n_segments
+            key = (int(sizes[segment]), tuple(sorted(class_sizes[segment].tolist())),
+                   tuple(sorted(cluster_sizes[group].tolist())))
+            if key not in self.emi_memo:
+                self.emi_memo[key] = expected_mutual_information(np.array(key[1]), np.array(key[2]), key[0])
+            emi[group] = self.emi_memo[key]
+
+        # Clamped away from zero with their signs kept, as sklearn does
+        denominator = (np.tile(h_true, n_models) + h_pred) / 2 - emi
+        denominator = np.where(denominator < 0, np.minimum(denominator, -eps), np.maximum(denominator, eps))
+        numerator = mi - emi
+        numerator = np.where(numerator < 0, np.minimum(numerator, -eps), np.maximum(numerator, eps))
+        ami = numerator / denominator
+        # A single gold or predicted cluster scores 0, unless both are single clusters
+        ami = np.where((np.tile(n_classes, n_models) == 1) | (n_clusters == 1), 0.0, ami)
+        ami = np.where((np.tile(n_classes, n_models) == 1) & (n_clusters == 1), 1.0, ami)
+        scores['ami'] = ami.reshape(n_models, n_segments)
+        return scores
+
+    def scores(self, predictions):
+        # {'micro_acc', 'macro_acc', 'micro_f1', ...: score of each model} for predictions of shape (models, items)
+        predictions = np.asarray(predictions, dtype=np.int64).reshape(-1, len(self.gold))
+        micro = self.segment_scores(predictions, self.segments, self.sizes)
+        macro = self.segment_scores(predictions, np.zeros_like(self.segments), np.array([len(self.gold)]))
+        results = {}
+        for metric in ['acc', 'f1', 'ami']:
+            results[f'micro_{metric}'] = micro[metric].mean(axis=1)
+            results[f'macro_{metric}'] = macro[metric][:, 0]
+        return results
+
+
+if __name__ == "__main__":
+    # Check against sklearn on random segmented labellings
+    from sklearn.metrics import accuracy_score, adjusted_mutual_info_score, f1_score
+
+    rng = np.random.default_rng(0)
+    sizes = rng.integers(1, 30, size=200)
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    gold = rng.integers(0, 6, size=offsets[-1])
+    predictions = rng.integers(0, 6, size=(5, offsets[-1]))
+    predictions[0] = gold
+    results = SegmentedLabels(gold, offsets).scores(predictions)
+    metrics = {'acc': accuracy_score, 'f1': lambda c, p: f1_score(c, p, average='weighted'),
+               'ami': adjusted_mutual_info_score}
+    for metric, function in metrics.items():
+        for model, prediction in enumerate(predictions):
+            micro = np.mean([function(gold[start:end], prediction[start:end])
+                             for start, end in zip(offsets[:-1], offsets[1:])])
+            assert np.isclose(results[f'micro_{metric}'][model], micro, rtol=0, atol=1e-9)
+            assert np.isclose(results[f'macro_{metric}'][model], function(gold, prediction), rtol=0, atol=1e-9)
+    info('Engine scores match sklearn')
@@ -1,4 +1,6 @@
 per_minute_requests = 1200
+download_workers = 32
+ox_api_url = 'https://oed-researcher-api.oxfordlanguages.com/oed/api/v0.2'
 
 credentials_file = 'data/credentials.csv'
 
@@ -7,20 +9,41 @@ annotator_2_alignment_file = 'data/gold_standard_alignments/annotator_2.csv'
 test_alignment_file = 'data/gold_standard_alignments/annotator_1_full.csv'
 
 ox_download_dir = 'data/ox_raw/'
-ox_processed_file = 'data/ox_raw/ox_processed.pkl'
-ox_dictionary_file = 'data/oxford.pkl'
-ox_lemma_info_file = 'data/oxford_lemma_info.pkl'
-wn_dictionary_file = 'data/wordnet.pkl'
+ox_store_file = 'data/ox_raw/ox_raw.sqlite'
+ox_processed_file = 'data/ox_raw/ox_processed.journal'
+legacy_ox_processed_file = 'data/ox_raw/ox_processed.pkl'
+ox_dictionary_dir = 'data/oxford/'
+ox_lemma_info_dir = 'data/oxford_lemma_info/'
+coarsener_memo_file = 'data/coarsener_memo.pkl'
+etymology_graph_dir = 'data/etymology_graph/'
+wn_definitions_file = 'data/definitions.pkl'
+wn_dictionary_dir = 'data/wordnet/'
+wn_synset_counts_file = 'data/wn_synset_counts.pkl'
 
 test_data_file = 'data/test_homographs.pkl'
 
+embedding_cache_dir = 'data/embedding_cache/'
+embedding_cache_max_entries = 1000000
+encode_batch_size = 128
+lesk_token_cache_file = 'data/lesk_tokens.pkl'
+
 full_alignment_file = 'output/full_alignment.pkl'
+full_alignment_state_file = 'output/full_alignment_state.pkl'
 mapping_dir = 'output/alignments/'
 results_file = 'output/results.csv'
+evaluation_cache_file = 'output/evaluation_cache.pkl'
 
 between_pos_pkl_file = 'output/between_pos_clusters.pkl'
 within_pos_pkl_file = 'output/within_pos_clusters.pkl'
 raw_pkl_file = 'output/raw_clusters.pkl'
+homographs_state_file = 'output/homographs_state.pkl'
+shard_dir = 'output/shards/'
+analysis_json_file = 'output/analysis.json'
+analysis_csv_file = 'output/analysis.csv'
 
 between_pos_csv_file = 'data/between_pos_clusters.csv'
 within_pos_csv_file = 'data/within_pos_clusters.csv'
+raw_csv_file = 'data/raw_clusters.csv'
+
+pipeline_state_file = 'data/pipeline_state.pkl'
+pipeline_log_dir = 'output/logs/'
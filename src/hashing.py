@@ -0,0 +1,74 @@
+# Content hashes of files and of the code a module runs, shared by the pipeline runner and the stages that cache results
+import ast
+import hashlib
+import os
+
+
+class Hasher:
+    # Content hashes of files and directories, reused while a file's size and mtime are unchanged
+
+    def __init__(self, cache):
+        self.cache = cache  # path -> (size, mtime_ns, digest)
+
+    def file_digest(self, path):
+        stat = os.stat(path)
+        cached = self.cache.get(path)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                digest.update(block)
+        self.cache[path] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+        return digest.hexdigest()
+
+    def digest(self, path):
+        if os.path.isfile(path):
+            return self.file_digest(path)
+        if not os.path.isdir(path):
+            return None
+        digest = hashlib.sha1()
+        for directory, subdirectories, files in os.walk(path):
+            subdirectories.sort()
+            for file in sorted(files):
+                file_path = os.path.join(directory, file)
+                digest.update(f'{os.path.relpath(file_path, path)}:{self.file_digest(file_path)}\n'.encode())
+        return digest.hexdigest()
+
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def module_file(module):
+    # Relative to the working directory (so src/... when run from the repo root, as the stages are), but found from
+    # wherever they are run
+    return os.path.relpath(os.path.join(root_dir, module.replace('.', '/') + '.py'))
+
+
+def code_files(module):
+    # The module and every src module it imports, directly or not
+    files = set()
+    queue = [module]
+    while len(queue) > 0:
+        file = module_file(queue.pop())
+        if file in files or not os.path.exists(file):
+            continue
+        files.add(file)
+        with open(file) as fp:
+            tree = ast.parse(fp.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom) and node.module is not None and node.module.startswith('src'):
+                queue.append(node.module)
+                queue.extend(f'{node.module}.{alias.name}' for alias in node.names)
+            elif isinstance(node, ast.Import):
+                queue.extend(alias.name for alias in node.names if alias.name.startswith('src'))
+    return sorted(files)
+
+
+def code_digest(module, hasher):
+    # One digest of the module and every src module it imports, for stages whose saved state is only valid for the
+    # code that produced it
+    digest = hashlib.sha1()
+    for file in code_files(module):
+        digest.update(f'{file}:{hasher.digest(file)}\n'.encode())
+    return digest.hexdigest()
@@ -1,100 +1,176 @@
 # Input with a set of lemmas (dicts), coarsens their IDs
 import itertools
+import os
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-
+from src.batch_coarsening import BatchCoarsener
 from src.common import warn, open_pickle, get_credentials, save_pickle, info
-from src.global_variables import ox_lemma_info_file
+from src.global_variables import ox_lemma_info_dir, coarsener_memo_file, per_minute_requests, download_workers
+from src.mapped_files import load_lemma_info, save_lemma_info, directory_signature
+from src.ox_requestor import OxRequestor
 
 app_id, ox_key = get_credentials()
 
+missing_lemma_modes = ['fetch', 'fail', 'leaf']
+
+
+def lemma_info_from_api(parsed_sub_data):
+    instance_derivations_chain = {e['target_id'] for e in
+                                  parsed_sub_data['data']['etymology']['etymons'] if
+                                  'target_id' in e.keys() and e['part_of_speech'] != 'SUFFIX'}
+    instance_etymology_lookup = {tuple(e) for e in
+                                 parsed_sub_data['data']['etymology']['etymon_language']}
+    instance_full_etymology = parsed_sub_data['data']['etymology']
+    instance_pronunciations = parsed_sub_data['data']['pronunciations']
+
+    return {
+        'full_etymology': instance_full_etymology,
+        'derivation_chain': instance_derivations_chain,
+        'etymology_lookup': instance_etymology_lookup,
+        'pronunciation': instance_pronunciations
+    }
 
-class HomographCoarsenerV1:
 
-    def __init__(self):
-        self.lemma_info = open_pickle(ox_lemma_info_file)
+class HomographCoarsenerV1(BatchCoarsener):
+
+    def __init__(self, memo_file=coarsener_memo_file, missing_lemmas='fetch'):
+        # missing_lemmas says what to do with derivations absent from the lemma info: 'fetch' them from the API,
+        # 'fail' straight away, or treat them as 'leaf' lemmas with no etymology
+        assert missing_lemmas in missing_lemma_modes
+        self.missing_lemmas = missing_lemmas
+        self.requestor = None
+        self.lemma_info = load_lemma_info(ox_lemma_info_dir)  # Decoded lazily, per lemma
         self.updated_lemmas = False
 
+        # Coarse lemma id -> (etymology set, full etymologies, skip flag), so each lemma's graph is walked once
+        self.memo_file = memo_file
+        self.memo = {}
+        self.memo_hits = 0
+        self.memo_misses = 0
+        if memo_file is not None and os.path.exists(memo_file):
+            signature, memo = open_pickle(memo_file)
+            if signature == self.lemma_info_signature():
+                self.memo = memo
+            else:
+                info('Lemma info has changed since the coarsening memo was saved; ignoring it')
+
+    def lemma_info_signature(self):
+        # Lemmas resolved with missing leaves are only valid while lemmas are still treated that way
+        return directory_signature(ox_lemma_info_dir) + (self.missing_lemmas == 'leaf',)
+
+    def fetch_lemmas(self, lemma_ids):
+        # Download lemmas concurrently, sharing one rate limit
+        if self.requestor is None:
+            self.requestor = OxRequestor(app_id, ox_key, per_minute_requests, workers=download_workers)
+        lemma_ids = sorted(lemma_ids)
+        urls = [self.requestor.url_base + f'/word/{lemma_id}' for lemma_id in lemma_ids]
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            for lemma_id, parsed_sub_data in zip(lemma_ids, executor.map(self.requestor.request, urls)):
+                self.lemma_info[lemma_id] = lemma_info_from_api(parsed_sub_data)
+        if len(lemma_ids) > 0:
+            self.updated_lemmas = True
+
+    def prefetch(self, coarse_ids):
+        # Walk every derivation chain reachable from coarse_ids, downloading all missing lemmas level by level, so
+        # that coarsening them afterwards never waits on the network
+        if self.missing_lemmas != 'fetch':
+            return
+        seen = set()
+        frontier = set(coarse_ids)
+        fetched = 0
+        while len(frontier) > 0:
+            seen.update(frontier)
+            missing = {lemma_id for lemma_id in frontier if lemma_id not in self.lemma_info.keys()}
+            if len(missing) > 0:
+                info(f'Fetching {len(missing)} missing lemmas')
+                self.fetch_lemmas(missing)
+                fetched += len(missing)
+            next_frontier = set()
+            for lemma_id in frontier:
+                next_frontier.update(self.lemma_info[lemma_id]['derivation_chain'])
+            frontier = next_frontier - seen
+        info(f'Prefetched {fetched} lemmas reachable from {len(set(coarse_ids))}')
+
+    def resolve(self, course_id, warn_cycles=False):
+        if course_id in self.memo:
+            self.memo_hits += 1
+            return self.memo[course_id]
+        self.memo_misses += 1
+
+        etymology = set()
+        full_etymologies = []
+        queue = [course_id]
+        seen = set()
+        add_all_seen = False
+        while len(queue) > 0:
+            next_step_id = queue.pop()
+
+            skip_addition = False
+            # Check for cycles
+            if next_step_id in seen:
+                if warn_cycles:
+                    warn(f'Cycle detected for {course_id}')
+                skip_addition = True
+                add_all_seen = True
+            else:
+                seen.add(next_step_id)
+
+            if next_step_id not in self.lemma_info.keys():
+                if self.missing_lemmas == 'fail':
+                    raise KeyError(f'Lemma {next_step_id} (derived from by {course_id}) is not in the lemma info')
+                elif self.missing_lemmas == 'leaf':
+                    continue
+                # Find it from online if it isn't local
+                self.fetch_lemmas([next_step_id])
+
+            next_step = self.lemma_info[next_step_id]
+            next_step_is_derived_from = next_step['derivation_chain']
+
+            if len(next_step_is_derived_from) == 0:
+                for et in next_step['etymology_lookup']:
+                    etymology.add(et)
+                full_etymologies.append(next_step['full_etymology'])
+            else:
+                if not skip_addition:
+                    queue.extend(list(next_step_is_derived_from))
+
+        # If there is a cycle with no bottoming out, use all their etymologies
+        if add_all_seen:
+            for seen_id in seen:
+                if seen_id not in self.lemma_info.keys():
+                    continue
+                seen_lemma = self.lemma_info[seen_id]
+                for et in seen_lemma['etymology_lookup']:
+                    etymology.add(et)
+                full_etymologies.append(seen_lemma['full_etymology'])
+
+        # Skip this lemma if all its etymologies are unknown
+        skip = len(full_etymologies) > 0
+        for full_etymology in full_etymologies:
+            if full_etymology['etymology_type'] != 'unknown' and \
+                    full_etymology['etymon_language'] != [['undetermined']] and \
+                    (not (full_etymology['etymon_language'] == [['Other sources', 'origin uncertain']] and
+                          full_etymology['source_language'] == [])):
+                skip = False
+                break
+
+        resolved = (frozenset(etymology), full_etymologies, skip)
+        self.memo[course_id] = resolved
+        return resolved
+
+    def memo_stats(self):
+        return {'entries': len(self.memo), 'hits': self.memo_hits, 'misses': self.memo_misses}
+
     def coarsen_homographs(self, lemmas_codes, warn_cycles=False):
 
         derivation_dict = {}
-        all_full_etymologies = defaultdict(list)
-
+        skip_etymologies = set()
         for course_id in set(lemmas_codes):
-            etymology = set()
-            queue = [course_id]
-            seen = set()
-            add_all_seen = False
-            while len(queue) > 0:
-                next_step_id = queue.pop()
-
-                skip_addition = False
-                # Check for cycles
-                if next_step_id in seen:
-                    if warn_cycles:
-                        warn(f'Cycle detected for {course_id}')
-                    skip_addition = True
-                    add_all_seen = True
-                else:
-                    seen.add(next_step_id)
-
-                if next_step_id not in self.lemma_info.keys():
-                    # Find it from online if it isn't local
-                    parsed_sub_data = requests.get(
-                        f'https://oed-researcher-api.oxfordlanguages.com/oed/api/v0.2/word/{next_step_id}',
-                        headers={"app_id": app_id, "app_key": ox_key}).json()
-                    instance_derivations_chain = {e['target_id'] for e in
-                                                  parsed_sub_data['data']['etymology']['etymons'] if
-                                                  'target_id' in e.keys() and e['part_of_speech'] != 'SUFFIX'}
-                    instance_etymology_lookup = {tuple(e) for e in
-                                                 parsed_sub_data['data']['etymology']['etymon_language']}
-                    instance_full_etymology = parsed_sub_data['data']['etymology']
-                    instance_pronunciations = parsed_sub_data['data']['pronunciations']
-
-                    # Add to lemma_dict and save
-                    self.lemma_info[next_step_id] = {
-                        'full_etymology': instance_full_etymology,
-                        'derivation_chain': instance_derivations_chain,
-                        'etymology_lookup': instance_etymology_lookup,
-                        'pronunciation': instance_pronunciations
-                    }
-
-                    self.updated_lemmas = True
-
-                next_step_is_derived_from = self.lemma_info[next_step_id]['derivation_chain']
-
-                if len(next_step_is_derived_from) == 0:
-                    for et in self.lemma_info[next_step_id]['etymology_lookup']:
-                        etymology.add(et)
-                    all_full_etymologies[course_id].append(self.lemma_info[next_step_id]['full_etymology'])
-                else:
-                    if not skip_addition:
-                        queue.extend(list(next_step_is_derived_from))
-
-            # If there is a cycle with no bottoming out, use all their etymologies
-            if add_all_seen:
-                for seen_id in seen:
-                    for et in self.lemma_info[seen_id]['etymology_lookup']:
-                        etymology.add(et)
-                    all_full_etymologies[course_id].append(self.lemma_info[seen_id]['full_etymology'])
-
+            etymology, _, skip = self.resolve(course_id, warn_cycles=warn_cycles)
             derivation_dict[course_id] = etymology
-
-        # info('Remove senses without etymology')
-        skip_etymologies = set()
-        for coarse_id, etymologies in all_full_etymologies.items():
-            skip = True
-            for etymology in etymologies:
-                # Skip this entry if its etymology is unknown
-                if etymology['etymology_type'] != 'unknown' and \
-                        etymology['etymon_language'] != [['undetermined']] and \
-                        (not (etymology['etymon_language'] == [['Other sources', 'origin uncertain']] and etymology[
-                            'source_language'] == [])):
-                    skip = False
-                    break
             if skip:
-                skip_etymologies.add(coarse_id)
+                skip_etymologies.add(course_id)
 
         # info('Combining for items')
         homograph_dict = {}
@@ -206,10 +282,15 @@ class HomographCoarsenerV1:
 
     def save(self):
         if self.updated_lemmas:
-            save_pickle(ox_lemma_info_file, self.lemma_info)
+            save_lemma_info(ox_lemma_info_dir, self.lemma_info)
         else:
             info('No new lemmas downloaded')
 
+        stats = self.memo_stats()
+        info(f"Coarsening memo: {stats['entries']} lemmas, {stats['hits']} hits, {stats['misses']} misses")
+        if self.memo_file is not None:
+            save_pickle(self.memo_file, (self.lemma_info_signature(), self.memo))
+
 
 # For debug
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+# Same clusters as HomographCoarsenerV1, merged in one pass with union-find and a trie over etymology chains
+from collections import defaultdict
+
+from src.common import info, warn
+from src.homograph_coarsener_v1 import HomographCoarsenerV1
+
+
+class UnionFind:
+
+    def __init__(self, size):
+        self.parents = list(range(size))
+
+    def find(self, item):
+        root = item
+        while self.parents[root] != root:
+            root = self.parents[root]
+        # Path compression
+        while self.parents[item] != root:
+            self.parents[item], item = root, self.parents[item]
+        return root
+
+    def union(self, item_1, item_2):
+        root_1 = self.find(item_1)
+        root_2 = self.find(item_2)
+        if root_1 != root_2:
+            self.parents[root_2] = root_1
+
+
+def merge_lemmas(etymology_sets):
+    # V1 merges clusters that share an etymology chain, then clusters where a chain of one is a prefix of a chain of
+    # the other, until neither changes anything. Equal chains are prefixes of each other, so the result is the
+    # connected components of lemmas under the prefix relation. Returns each lemma's component root
+    union_find = UnionFind(len(etymology_sets))
+
+    # Trie over chain elements; a node's 'end' is the first lemma with a chain ending there
+    end = object()
+    trie = {}
+    for index, etymologies in enumerate(etymology_sets):
+        for chain in etymologies:
+            assert len(chain) > 0
+            node = trie
+            for element in chain:
+                node = node.setdefault(element, {})
+            if end in node:
+                union_find.union(node[end], index)
+            else:
+                node[end] = index
+
+    # Each chain is joined to every chain that is a (strict) prefix of it
+    for index, etymologies in enumerate(etymology_sets):
+        for chain in etymologies:
+            node = trie
+            for element in chain[:-1]:
+                node = node[element]
+                if end in node:
+                    union_find.union(node[end], index)
+
+    return [union_find.find(index) for index in range(len(etymology_sets))]
+
+
+class HomographCoarsenerV2(HomographCoarsenerV1):
+
+    def coarsen_homographs(self, lemmas_codes, warn_cycles=False):
+
+        lemmas = sorted(set(lemmas_codes))
+        resolved = [self.resolve(lemma, warn_cycles=warn_cycles) for lemma in lemmas]
+
+        # If one is excluded, exclude all
+        if any(skip for (_, _, skip) in resolved):
+            return ['exclude'] * len(lemmas_codes)
+
+        roots = merge_lemmas([etymology for (etymology, _, _) in resolved])
+
+        # Name clusters by their lemmas
+        root_to_lemmas = defaultdict(list)
+        for lemma, root in zip(lemmas, roots):
+            root_to_lemmas[root].append(lemma)
+        lemma_to_name = {}
+        for cluster_lemmas in root_to_lemmas.values():
+            name = '/'.join(cluster_lemmas)
+            for lemma in cluster_lemmas:
+                lemma_to_name[lemma] = name
+
+        return [lemma_to_name[lemma] for lemma in lemmas_codes]
+
+
+# Differential check against V1 over every word in the Oxford dictionary
+if __name__ == "__main__":
+    from src.columnar_dictionary import load_dictionary
+    from src.global_variables import ox_dictionary_dir
+
+    ox_dict = load_dictionary(ox_dictionary_dir)
+    hc_v1 = HomographCoarsenerV1()
+    hc_v2 = HomographCoarsenerV2()
+    hc_v2.memo = hc_v1.memo  # Share the resolved lemmas, so only the merging differs
+
+    groups = []
+    word_lemmas = defaultdict(set)
+    for (word, pos), entries in ox_dict.items():
+        pos_lemmas = sorted({entry['coarse_lemma_id'] for entry in entries.values()})
+        groups.append(pos_lemmas)
+        word_lemmas[word].update(pos_lemmas)
+    groups.extend(sorted(lemmas) for lemmas in word_lemmas.values())
+
+    mismatches = 0
+    for i, group in enumerate(groups):
+        if i % 10000 == 0:
+            info(f'Checking group {i}/{len(groups)}')
+        clusters_v1 = hc_v1.coarsen_homographs(group)
+        clusters_v2 = hc_v2.coarsen_homographs(group)
+        if clusters_v1 != clusters_v2:
+            mismatches += 1
+            warn(f'Mismatch for {group}: {clusters_v1} (V1) vs {clusters_v2} (V2)')
+
+    info(f'{mismatches} mismatches over {len(groups)} groups')
+    assert mismatches == 0
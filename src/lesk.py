@@ -0,0 +1,73 @@
+# LESK overlap baseline over interned, cached definition tokens, scored with sparse matrices
+import os
+from string import punctuation
+
+import numpy as np
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+from nltk.tokenize import word_tokenize
+from scipy.sparse import csr_matrix
+
+from src.alignment_scoring import segment_pairs, pair_argmax
+from src.common import open_pickle, save_pickle, info
+from src.global_variables import lesk_token_cache_file
+
+
+class LeskEngine:
+
+    def __init__(self, cache_file=lesk_token_cache_file):
+        self.cache_file = cache_file
+        self.lemmatizer = WordNetLemmatizer()
+        self.stopwords = set(stopwords.words('english'))
+        self.punctuation = set(punctuation)
+
+        self.vocab = {}  # token -> id
+        self.definition_tokens = {}  # definition -> sorted token ids
+        if os.path.exists(cache_file):
+            self.vocab, self.definition_tokens = open_pickle(cache_file)
+        self.updated = False
+
+    def tokens_sentence(self, sentence):
+        return {self.lemmatizer.lemmatize(w.lower()) for w in word_tokenize(sentence)
+                if w.lower() not in self.stopwords and w.lower() not in self.punctuation}
+
+    def token_ids(self, definition):
+        if definition not in self.definition_tokens:
+            ids = set()
+            for token in self.tokens_sentence(definition):
+                if token not in self.vocab:
+                    self.vocab[token] = len(self.vocab)
+                ids.add(self.vocab[token])
+            self.definition_tokens[definition] = tuple(sorted(ids))
+            self.updated = True
+        return self.definition_tokens[definition]
+
+    def matrix(self, definitions):
+        # Binary definition x token matrix, and the number of tokens in each definition
+        rows = [self.token_ids(definition) for definition in definitions]
+        lengths = np.array([len(row) for row in rows], dtype=np.int64)
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        indices = np.array([token for row in rows for token in row], dtype=np.int64)
+        data = np.ones(len(indices), dtype=np.float64)
+        return csr_matrix((data, indices, indptr), shape=(len(definitions), len(self.vocab))), lengths
+
+    def best_matches(self, wn_defs, ox_defs, wn_offsets, ox_offsets, ox_mask=None):
+        # For each WN definition, the index of the OX definition in its segment with the largest overlap divided
+        # by the smaller token count (zero if either has no tokens)
+        wn_matrix, wn_lengths = self.matrix(wn_defs)
+        ox_matrix, ox_lengths = self.matrix(ox_defs)
+        wn_matrix.resize((len(wn_defs), len(self.vocab)))
+
+        pair_wn, pair_ox = segment_pairs(wn_offsets, ox_offsets, ox_mask)
+        overlaps = np.asarray(wn_matrix[pair_wn].multiply(ox_matrix[pair_ox]).sum(axis=1)).ravel()
+        min_lengths = np.minimum(wn_lengths[pair_wn], ox_lengths[pair_ox])
+        scores = np.divide(overlaps, min_lengths, out=np.zeros(len(overlaps)), where=min_lengths > 0)
+
+        return pair_argmax(pair_wn, pair_ox, scores, len(wn_defs))
+
+    def save(self):
+        if self.updated:
+            save_pickle(self.cache_file, (self.vocab, self.definition_tokens))
+            self.updated = False
+        else:
+            info('No new LESK tokenisations')
@@ -0,0 +1,194 @@
+# Directories of memory-mapped arrays and tables, decoded lazily per item so they open instantly and need not fit in
+# memory. A table holds strings or pickled values, concatenated with an array of offsets
+import fcntl
+import glob
+import os
+import pickle
+import shutil
+import time
+from collections.abc import Mapping
+
+import numpy as np
+
+from src.common import info, open_pickle, save_pickle
+
+
+def save_array(directory, name, array):
+    np.save(os.path.join(directory, f'{name}.npy'), array)
+
+
+def load_array(directory, name):
+    # A plain array over the mapped file, as indexing a np.memmap is several times slower
+    return np.asarray(np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r'))
+
+
+def save_table(directory, name, values):
+    kind = 'str' if all(isinstance(value, str) for value in values) else 'pickle'
+    if kind == 'str':
+        encoded = [value.encode() for value in values]
+    else:
+        encoded = [pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL) for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in encoded])
+    save_array(directory, f'{name}_offsets', offsets)
+    save_array(directory, f'{name}_{kind}', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+
+immutable_types = (str, int, float, bool, type(None))
+
+
+class Table:
+
+    def __init__(self, directory, name, cache_size=100000):
+        self.offsets = load_array(directory, f'{name}_offsets')
+        self.is_str = os.path.exists(os.path.join(directory, f'{name}_str.npy'))
+        self.data = memoryview(load_array(directory, f'{name}_str' if self.is_str else f'{name}_pickle'))
+        # Decoded immutable values, so repeated values (pos, lemma ids, dates) are decoded once
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def decode(self, encoded):
+        return encoded.decode() if self.is_str else pickle.loads(encoded)
+
+    def __getitem__(self, index):
+        if index in self.cache:
+            return self.cache[index]
+        value = self.decode(self.data[self.offsets[index]:self.offsets[index + 1]].tobytes())
+        if len(self.cache) < self.cache_size and isinstance(value, immutable_types):
+            self.cache[index] = value
+        return value
+
+    def decode_all(self):
+        # Every value, decoded in one pass for full scans. Mutable values are also returned encoded by index, so each
+        # use can decode its own copy as __getitem__ gives
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        if self.is_str:
+            return [data[start:end].decode() for start, end in zip(offsets[:-1], offsets[1:])], {}
+        encoded = [data[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        values = [pickle.loads(item) for item in encoded]
+        mutable = {index: encoded[index] for index, value in enumerate(values)
+                   if not isinstance(value, immutable_types)}
+        return values, mutable
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def search_sorted(count, value, value_at):
+    # Position of value among count sorted items, or None if it is absent
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        if value_at(middle) < value:
+            low = middle + 1
+        else:
+            high = middle
+    if low < count and value_at(low) == value:
+        return low
+    return None
+
+
+def version_time(path):
+    # The time_ns a {directory}.version-<time_ns> directory (or its .link) was started at
+    return int(path.rsplit('.version-', 1)[1].split('.')[0])
+
+
+def replace_directory(directory, write):
+    # write(version) fills a fresh directory, and directory (a symlink) is then pointed at it by an atomic rename.
+    # Readers resolve the link once and open every file from the version it points to, so they never mix two. Writers
+    # hold a lock, so one never removes a version another is still writing
+    directory = directory.rstrip('/')
+    with open(f'{directory}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        version = f'{directory}.version-{time.time_ns()}'
+        os.makedirs(version)
+        write(version)
+
+        link = version + '.link'
+        os.symlink(os.path.basename(version), link)
+        replaced = os.path.realpath(directory) if os.path.islink(directory) else None
+        if os.path.isdir(directory) and not os.path.islink(directory):
+            # A directory written before these were symlinks has to be moved aside once, which briefly leaves no path
+            replaced = f'{directory}.version-0'
+            os.rename(directory, replaced)
+        os.replace(link, directory)
+
+        # The replaced version is kept for readers that resolved it just before the switch, and removed by the next
+        # write along with anything older, such as versions left by interrupted writes
+        if replaced is not None:
+            for stale in glob.glob(f'{glob.escape(directory)}.version-*'):
+                if version_time(stale) < version_time(replaced):
+                    if os.path.islink(stale):
+                        os.remove(stale)
+                    else:
+                        shutil.rmtree(stale)
+
+
+def directory_signature(directory):
+    # Changes whenever the directory is rewritten, as meta.pkl is written last
+    stat = os.stat(os.path.join(directory, 'meta.pkl'))
+    return stat.st_size, stat.st_mtime_ns
+
+
+def legacy_pickle(directory):
+    # The pickle a directory replaces, e.g. data/oxford.pkl for data/oxford/
+    return directory.rstrip('/') + '.pkl'
+
+
+def save_lemma_info(directory, lemma_info):
+    lemma_ids = sorted(lemma_info.keys())
+
+    def write(temporary):
+        save_table(temporary, 'lemma_ids', lemma_ids)
+        save_table(temporary, 'infos', [lemma_info[lemma_id] for lemma_id in lemma_ids])
+        save_pickle(os.path.join(temporary, 'meta.pkl'), {'lemmas': len(lemma_ids)})
+
+    replace_directory(directory, write)
+
+
+class LemmaInfo(Mapping):
+    # Lemma id -> info, mapped from a directory. Lemmas set afterwards are held in memory until saved
+
+    def __init__(self, directory):
+        directory = os.path.realpath(directory)  # Resolved once, so every file comes from the same version
+        self.lemma_ids = Table(directory, 'lemma_ids')
+        self.infos = Table(directory, 'infos')
+        self.added = {}
+        self.lemma_count = len(self.lemma_ids)  # Including added lemmas, so len() needs no scan
+
+    def position(self, lemma_id):
+        return search_sorted(len(self.lemma_ids), lemma_id, self.lemma_ids.__getitem__)
+
+    def __getitem__(self, lemma_id):
+        if lemma_id in self.added:
+            return self.added[lemma_id]
+        position = self.position(lemma_id)
+        if position is None:
+            raise KeyError(lemma_id)
+        return self.infos[position]
+
+    def __setitem__(self, lemma_id, lemma_info):
+        if lemma_id not in self:
+            self.lemma_count += 1
+        self.added[lemma_id] = lemma_info
+
+    def __contains__(self, lemma_id):
+        return lemma_id in self.added or self.position(lemma_id) is not None
+
+    def __iter__(self):
+        for position in range(len(self.lemma_ids)):
+            lemma_id = self.lemma_ids[position]
+            if lemma_id not in self.added:
+                yield lemma_id
+        yield from self.added
+
+    def __len__(self):
+        return self.lemma_count
+
+
+def load_lemma_info(directory):
+    if not os.path.exists(directory):
+        info(f'Converting {legacy_pickle(directory)} to {directory}')
+        save_lemma_info(directory, open_pickle(legacy_pickle(directory)))
+    return LemmaInfo(directory)
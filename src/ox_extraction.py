@@ -0,0 +1,171 @@
+# Extract definitions and lemma info from the raw ox responses; shared by the serial and parallel paths of s04
+from collections import defaultdict
+
+from src.common import warn
+from src.global_variables import ox_store_file
+from src.ox_store import OxStore
+
+ox_pos_reverse = {
+    'NN': 'noun',
+    'NNS': 'noun',
+    'NNP': 'noun',
+    'NNPS': 'noun',
+    'VB': 'verb',
+    'VBD': 'verb',
+    'VBG': 'verb',
+    'VBN': 'verb',
+    'VBP': 'verb',
+    'VBZ': 'verb',
+    'RB': 'adv',
+    'RBR': 'adv',
+    'RBS': 'adv',
+    'JJ': 'adj',
+    'JJR': 'adj',
+    'JJS': 'adj'
+}
+
+worker_store = None
+
+
+def slim_word(store, word):
+    # Load a word and its entries, keeping only the (ordered) fields extract_word uses
+    parsed_data = store.get_word(word)
+    if parsed_data is None:
+        return None
+
+    ids = {datapoint['id'] for datapoint in parsed_data['data']}
+    id_to_sense = {}
+    for id in ids:
+        id_to_sense[id] = store.get_entry(id)
+
+    entries = []
+    for entry in parsed_data['data']:
+        entries.append({
+            'id': entry['id'],
+            'etymology': entry['etymology'],
+            'pronunciations': entry['pronunciations'],
+            'definition': entry['definition'],
+            'parts_of_speech': entry['parts_of_speech'],
+            'senses': [{
+                'id': sub_entry['id'],
+                'start': sub_entry['daterange']['start'],
+                'end': sub_entry['daterange']['end'],
+                'categories': sub_entry['categories']['topic'],
+                'definition': sub_entry['definition']
+            } for sub_entry in id_to_sense[entry['id']]['data']]
+        })
+    return entries
+
+
+def init_worker():
+    global worker_store
+    worker_store = OxStore(ox_store_file, readonly=True)
+
+
+def extract_words(words):
+    # Extract a shard of words in a worker, for s04 to merge into the full definitions and lemma info
+    definitions = defaultdict(dict)
+    lemma_info = {}
+    encountered_entries = set()
+    for word in words:
+        entries = slim_word(worker_store, word)
+        if entries is not None:
+            extract_word(word, entries, definitions, lemma_info, encountered_entries)
+    return definitions, lemma_info, encountered_entries
+
+
+def merge_extracted(shard, definitions, lemma_info, encountered_entries):
+    # Merge a shard from extract_words, with the same checks extract_word makes within a shard
+    shard_definitions, shard_lemma_info, shard_encountered_entries = shard
+    for key, sub_entries in shard_definitions.items():
+        assert key not in definitions.keys()  # Shards cover disjoint words
+        definitions[key] = sub_entries
+
+    for entry_id, combined_data in shard_lemma_info.items():
+        if entry_id in lemma_info.keys():
+            assert lemma_info[entry_id] == combined_data
+        else:
+            lemma_info[entry_id] = combined_data
+
+    assert encountered_entries.isdisjoint(shard_encountered_entries)
+    encountered_entries.update(shard_encountered_entries)
+
+
+def extract_word(word, entries, definitions, lemma_info, encountered_entries):
+    # Adds the word's senses and lemmas, checking them against those already extracted
+    for entry in entries:  # Each lemma
+        entry_id = entry['id']
+
+        derived_from = {e['target_id'] for e in entry['etymology']['etymons'] if 'target_id' in e.keys() and e['part_of_speech'] != 'SUFFIX'}
+
+        etymologies = entry['etymology']['etymon_language']
+        if etymologies == [['Other sources', 'origin uncertain']]:
+            etymologies = entry['etymology']['source_language']
+        if etymologies == [['English']]:
+            etymologies = [['Indo-European', 'Germanic', 'West Germanic', 'English']]
+
+        if entry['etymology']['etymology_type'] == 'acronym':
+            derivations = {('acronym', entry_id)}  # Special case to handle acronyms
+        elif entry['etymology']['etymology_type'] in {'properName', 'properNameHybrid'}:
+            derivations = {('proper_name', entry_id)}  # Special case to handle acronyms
+        else:
+            derivations = {tuple(e) for e in etymologies}
+
+        pronunciations = entry['pronunciations']
+
+        combined_data = {
+            'full_etymology': entry['etymology'],
+            'derivation_chain': derived_from,
+            'etymology_lookup': derivations,
+            'pronunciation': pronunciations
+        }
+
+        if entry_id in lemma_info.keys():
+            assert lemma_info[entry_id] == combined_data
+        else:
+            lemma_info[entry_id] = combined_data
+
+        main_definition = entry['definition']
+
+        poses = {ox_pos_reverse[p] for p in entry['parts_of_speech'] if p in ox_pos_reverse.keys()}
+        if len(poses) == 0:
+            continue
+        elif len(poses) > 1:
+            warn(f'Multiple POS ({poses}) for word {word} defined as {main_definition}')
+
+        found_main = False
+        added = 0
+        for i, sub_entry in enumerate(entry['senses']):
+            added += 1
+            start = sub_entry['start']
+            end = sub_entry['end']
+            categories = sub_entry['categories']
+            definition = sub_entry['definition']
+            main = False
+            if definition == main_definition:
+                main = True
+                found_main = True
+
+            for pos in poses:
+                if definition is not None and definition != '':
+
+                    sub_entry_id = sub_entry['id'] + ':' + word + ':' + pos
+
+                    assert sub_entry_id not in encountered_entries
+                    encountered_entries.add(sub_entry_id)
+
+                    definitions[(word, pos)][sub_entry_id] = {
+                        'id': sub_entry_id,
+                        'coarse_lemma_id': entry_id,
+                        'definition': definition,  # if definition is not None else '',
+                        'pos': pos,
+                        'start': start,
+                        'end': end,
+                        'categories': categories,
+                        'main': main,
+                    }
+
+        if added > 0:
+            if not found_main:
+                warn(f'Missing main for word {word}')
+                # NB this could break if the main one has an excluded POS
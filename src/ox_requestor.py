@@ -0,0 +1,109 @@
+# Concurrent, rate limited access to the OED researcher API
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.common import warn
+from src.global_variables import ox_api_url
+
+retry_statuses = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+
+    def __init__(self, per_minute, burst_fraction=0.02):
+        # Any 60 second window admits at most capacity + 60 * rate requests, so split the quota between the
+        # two to stay just under it
+        self.capacity = max(1, int(per_minute * burst_fraction))
+        self.rate = max(per_minute - self.capacity, 1) / 60  # Tokens per second
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class OxRequestor:
+
+    def __init__(self, app_id, key, per_minute, workers=16, url_base=ox_api_url, max_retries=5, backoff=1.0,
+                 timeout=60):
+        self.url_base = url_base
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.bucket = TokenBucket(per_minute)
+
+        # One keep-alive pool shared by every worker thread
+        self.session = requests.Session()
+        self.session.headers.update({"app_id": app_id, "app_key": key})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.in_flight = {}  # url -> Future of its parsed data
+        self.lock = threading.Lock()
+
+    def request(self, url):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            retry_after = None
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.status_code not in retry_statuses:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError(f'{response.status_code} for {url}', response=response)
+                retry_after = response.headers.get('Retry-After')
+
+            if attempt == self.max_retries:
+                raise error
+
+            if retry_after is not None and retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                delay = self.backoff * 2 ** attempt * (1 + random.random())
+            warn(f'{error}; retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+    def request_shared(self, url, handle=None):
+        # Only one thread fetches a given url at a time; others wait for its result. handle is run by the
+        # fetching thread before the url is released, so e.g. saving is done before anyone else checks for it
+        with self.lock:
+            future = self.in_flight.get(url)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[url] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            data = self.request(url)
+            if handle is not None:
+                handle(data)
+            future.set_result(data)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[url]
+        return data
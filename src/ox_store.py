@@ -0,0 +1,135 @@
+# Single-file, indexed store for the raw OED responses (words and entries), backed by SQLite
+import os
+import pickle
+import sqlite3
+import threading
+import zlib
+
+tables = ['words', 'entries']
+
+
+def encode(data, compress):
+    blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    if compress:
+        return 1, zlib.compress(blob)
+    return 0, blob
+
+
+def decode(compressed, blob):
+    if compressed:
+        blob = zlib.decompress(blob)
+    return pickle.loads(blob)
+
+
+class OxStore:
+
+    def __init__(self, file, compress=True, readonly=False):
+        self.file = file
+        self.compress = compress
+        self.readonly = readonly
+        self.lock = threading.Lock()
+
+        if readonly:
+            self.connection = sqlite3.connect(f'file:{file}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            self.connection = sqlite3.connect(file, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            for table in tables:
+                self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} '
+                                        f'(key TEXT PRIMARY KEY, compressed INTEGER, data BLOB) WITHOUT ROWID')
+            # Flags for one-off steps, e.g. importing the legacy pickle tree, so a step is only marked done once the
+            # transaction completing it has committed
+            self.connection.execute('CREATE TABLE IF NOT EXISTS flags (name TEXT PRIMARY KEY) WITHOUT ROWID')
+            self.connection.commit()
+
+    def _put(self, table, key, data, commit=True):
+        compressed, blob = encode(data, self.compress)
+        with self.lock:
+            self.connection.execute(f'INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)', (key, compressed, blob))
+            if commit:
+                self.connection.commit()
+
+    def _get(self, table, key):
+        with self.lock:
+            row = self.connection.execute(f'SELECT compressed, data FROM {table} WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return decode(*row)
+
+    def _has(self, table, key):
+        with self.lock:
+            row = self.connection.execute(f'SELECT 1 FROM {table} WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def _keys(self, table):
+        with self.lock:
+            return [key for (key,) in self.connection.execute(f'SELECT key FROM {table} ORDER BY key')]
+
+    def _scan(self, table):
+        # Sequential scan in key order, on its own cursor so it can be interleaved with lookups
+        cursor = self.connection.cursor()
+        for key, compressed, blob in cursor.execute(f'SELECT key, compressed, data FROM {table} ORDER BY key'):
+            yield key, decode(compressed, blob)
+
+    def put_word(self, word, data):
+        self._put('words', word, data)
+
+    def get_word(self, word):
+        return self._get('words', word)
+
+    def has_word(self, word):
+        return self._has('words', word)
+
+    def words(self):
+        return self._keys('words')
+
+    def scan_words(self):
+        return self._scan('words')
+
+    def put_entry(self, entry_id, data):
+        self._put('entries', entry_id, data)
+
+    def get_entry(self, entry_id):
+        return self._get('entries', entry_id)
+
+    def has_entry(self, entry_id):
+        return self._has('entries', entry_id)
+
+    def entries(self):
+        return self._keys('entries')
+
+    def scan_entries(self):
+        return self._scan('entries')
+
+    def has_flag(self, name):
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM flags WHERE name = ?', (name,)).fetchone()
+        return row is not None
+
+    def imported_pickle_tree(self):
+        return self.has_flag('imported_pickle_tree')
+
+    def import_pickle_tree(self, download_dir):
+        # Pack the legacy ox_raw/{words,entries}/<letter>/<key>.pkl tree into the store. The import is only flagged
+        # as done in its final commit, so an interrupted import is redone (overwriting its partial rows) next time
+        imported = 0
+        for table in tables:
+            table_dir = os.path.join(download_dir, table)
+            if not os.path.isdir(table_dir):
+                continue
+            for letter in sorted(os.listdir(table_dir)):
+                for file_name in sorted(os.listdir(os.path.join(table_dir, letter))):
+                    with open(os.path.join(table_dir, letter, file_name), 'rb') as fp:
+                        data = pickle.load(fp)
+                    self._put(table, file_name[:-len('.pkl')], data, commit=False)
+                    imported += 1
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO flags VALUES ('imported_pickle_tree')")
+            self.connection.commit()
+        return imported
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
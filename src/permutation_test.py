@@ -0,0 +1,96 @@
+# Paired permutation tests of the difference in accuracy or weighted F1 between two systems. Labels are integer
+# coded, each permutation swaps the two systems' predictions at random positions, and all permutations of a test are
+# scored at once from per-permutation confusion counts. Tests can stop early, once the p-value is clearly on one side
+# of a significance threshold
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.stats import beta
+
+from src.evaluation_engine import encode_labels
+
+metric_names = ['acc', 'f1']
+
+
+def scores(correct, predictions, n_labels, metric):
+    # Metric of each row of predictions (permutations x items) against correct, as sklearn's accuracy_score and
+    # f1_score(average='weighted') compute them
+    assert metric in metric_names, f'Unknown metric {metric}'
+    matches = predictions == correct[None, :]
+    if metric == 'acc':
+        return matches.mean(axis=1)
+
+    # Weighted F1 is sum_l support_l * 2 tp_l / (support_l + predicted_l) / n, over labels with support
+    n_permutations, n_items = predictions.shape
+    row_offsets = (np.arange(n_permutations) * n_labels)[:, None]
+    true_positives = np.bincount((correct[None, :] + row_offsets)[matches],
+                                 minlength=n_permutations * n_labels).reshape(n_permutations, n_labels)
+    predicted = np.bincount((predictions + row_offsets).ravel(),
+                            minlength=n_permutations * n_labels).reshape(n_permutations, n_labels)
+    support = np.bincount(correct, minlength=n_labels)
+    labels = np.flatnonzero(support)
+    f1 = 2 * true_positives[:, labels] / (support[labels] + predicted[:, labels])
+    return (f1 * support[labels]).sum(axis=1) / n_items
+
+
+def batch_sizes(r, first_batch, chunk_size):
+    # Doubling batches up to chunk_size, so clear cases stop after a few hundred permutations
+    sizes = []
+    while sum(sizes) < r:
+        sizes.append(min(first_batch * 2 ** len(sizes), chunk_size, r - sum(sizes)))
+    return sizes
+
+
+def is_decided(s, m, alpha, delta):
+    # Whether the Clopper-Pearson interval for the exceedance probability after m permutations, s of them at least
+    # the observed difference, lies wholly on one side of alpha
+    lower = beta.ppf(delta / 2, s, m - s + 1) if s > 0 else 0.0
+    upper = beta.ppf(1 - delta / 2, s + 1, m - s) if s < m else 1.0
+    return upper < alpha or lower > alpha
+
+
+def significance(assignments_1, assignments_2, correct, metric, r=10000, seed=0, alpha=None, delta=1e-3,
+                 first_batch=100, chunk_size=1000):
+    # p-value of the observed difference over up to r random swaps of the two assignments, and the number of swaps
+    # used. With alpha, stops as soon as the p-value is on one side of alpha with probability 1 - delta overall
+    assert len(assignments_1) == len(assignments_2)
+    assert len(assignments_2) == len(correct)
+    codes = {}
+    assignments_1, assignments_2, correct = encode_labels([assignments_1, assignments_2, correct], codes)
+    n_labels = len(codes)
+    observed_diff = np.abs(scores(correct, assignments_1[None, :], n_labels, metric) -
+                           scores(correct, assignments_2[None, :], n_labels, metric))[0]
+
+    rng = np.random.default_rng(seed)
+    sizes = batch_sizes(r, first_batch, chunk_size)
+    s = 0  # s is number of times the difference is at least that observed
+    m = 0  # Permutations so far
+    for size in sizes:
+        swaps = rng.random((size, len(correct))) < 0.5
+        shuffled_1 = np.where(swaps, assignments_2[None, :], assignments_1[None, :])
+        shuffled_2 = np.where(swaps, assignments_1[None, :], assignments_2[None, :])
+        shuffled_diff = np.abs(scores(correct, shuffled_1, n_labels, metric) -
+                               scores(correct, shuffled_2, n_labels, metric))
+        s += int(np.sum(shuffled_diff >= observed_diff))
+        m += size
+        if alpha is not None and is_decided(s, m, alpha, delta / len(sizes)):
+            break
+
+    p = (s + 1) / (m + 1)
+    return p, m
+
+
+def run_test(test):
+    return significance(*test)
+
+
+def significance_many(tests, r=10000, seed=0, alpha=None, workers=1):
+    # tests are (assignments_1, assignments_2, correct, metric); each gets its own stream from seed, so the results
+    # do not depend on the number of workers. Returns (p-value, permutations used) for each test
+    seeds = np.random.SeedSequence(seed).spawn(len(tests))
+    jobs = [(assignments_1, assignments_2, correct, metric, r, test_seed, alpha)
+            for (assignments_1, assignments_2, correct, metric), test_seed in zip(tests, seeds)]
+    if workers == 1:
+        return [run_test(job) for job in jobs]
+    with Pool(workers) as pool:
+        return pool.map(run_test, jobs)
@@ -0,0 +1,95 @@
+# Append-only journal of downloaded words and entries, replayed into sets on startup
+import os
+import threading
+
+word_record = 'w'
+entry_record = 'e'
+
+
+def read_journal(file):
+    # Returns the sets of processed words and entry ids. A torn final line (from a crash mid-write) is ignored
+    words = set()
+    entries = set()
+    if not os.path.exists(file):
+        return words, entries
+    with open(file, 'r') as fp:
+        for line in fp:
+            if not line.endswith('\n'):
+                break
+            record, value = line[:-1].split('\t', 1)
+            if record == word_record:
+                words.add(value)
+            else:
+                assert record == entry_record
+                entries.add(value)
+    return words, entries
+
+
+class ProgressJournal:
+
+    def __init__(self, file, sync_every=100):
+        self.file = file
+        self.sync_every = sync_every
+        self.words, self.entries = read_journal(file)
+        self.lock = threading.Lock()
+        self.unsynced = 0
+
+        self.fp = open(file, 'a')
+        self._repair()
+
+    def _repair(self):
+        # Drop any torn final line so new records are not appended onto it
+        with open(self.file, 'rb') as fp:
+            data = fp.read()
+        valid_length = data.rfind(b'\n') + 1
+        if valid_length != len(data):
+            self.fp.truncate(valid_length)
+
+    def _append(self, record, value):
+        assert '\t' not in value and '\n' not in value
+        with self.lock:
+            self.fp.write(f'{record}\t{value}\n')
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self._sync()
+
+    def _sync(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.unsynced = 0
+
+    def add_word(self, word):
+        self._append(word_record, word)
+        self.words.add(word)
+
+    def add_entry(self, entry_id):
+        self._append(entry_record, entry_id)
+        self.entries.add(entry_id)
+
+    def seed(self, words):
+        # Import words processed before the journal existed
+        for word in set(words) - self.words:
+            self.add_word(word)
+        with self.lock:
+            self._sync()
+
+    def compact(self):
+        # Rewrite the journal with one record per word and entry, atomically replacing the old one
+        with self.lock:
+            self._sync()
+            self.fp.close()
+            tmp_file = self.file + '.tmp'
+            with open(tmp_file, 'w') as fp:
+                for word in sorted(self.words):
+                    fp.write(f'{word_record}\t{word}\n')
+                for entry_id in sorted(self.entries):
+                    fp.write(f'{entry_record}\t{entry_id}\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp_file, self.file)
+            self.fp = open(self.file, 'a')
+
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.fp.close()
@@ -0,0 +1,209 @@
+# Run the stages in src/stages, skipping those whose code, inputs and arguments are unchanged since they last ran
+# e.g. python -m src.run_pipeline s07 --stage_args "s06:--models all-mpnet-base-v2"
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from src.common import info, warn, open_pickle, save_pickle
+from src.global_variables import wn_definitions_file, wn_dictionary_dir, test_alignment_file, test_data_file, \
+    ox_store_file, ox_processed_file, ox_dictionary_dir, ox_lemma_info_dir, annotator_1_alignment_file, \
+    annotator_2_alignment_file, coarsener_memo_file, etymology_graph_dir, mapping_dir, results_file, \
+    full_alignment_file, between_pos_pkl_file, within_pos_pkl_file, raw_pkl_file, between_pos_csv_file, \
+    within_pos_csv_file, raw_csv_file, pipeline_state_file, pipeline_log_dir, full_alignment_state_file, \
+    homographs_state_file, evaluation_cache_file, wn_synset_counts_file, analysis_json_file, analysis_csv_file
+from src.hashing import Hasher, code_files
+
+# 'updates' are inputs a stage may also rewrite (lemmas fetched while coarsening), so stages touching them never overlap
+# 'resources' are held for a whole run ('model' is a sentence embedding model, up to sentence-t5-xxl), so stages sharing
+# one never overlap either
+stages = {
+    's01': {'module': 'src.stages.s01_extract_wn',
+            'inputs': [wn_definitions_file],
+            'outputs': [wn_dictionary_dir, wn_synset_counts_file]},
+    's02': {'module': 'src.stages.s02_extract_test_data',
+            'inputs': [test_alignment_file],
+            'outputs': [test_data_file]},
+    's03': {'module': 'src.stages.s03_download_ox',
+            'inputs': [wn_dictionary_dir],
+            'outputs': [ox_store_file, ox_processed_file]},
+    's04': {'module': 'src.stages.s04_extract_ox',
+            'inputs': [ox_store_file, ox_processed_file, test_data_file],
+            'outputs': [ox_dictionary_dir, ox_lemma_info_dir]},
+    's05': {'module': 'src.stages.s05_evaluate_annotation',
+            'inputs': [annotator_1_alignment_file, annotator_2_alignment_file, test_alignment_file, ox_dictionary_dir,
+                       wn_dictionary_dir, ox_lemma_info_dir],
+            'outputs': [],
+            'updates': [ox_lemma_info_dir, coarsener_memo_file]},
+    's06': {'module': 'src.stages.s06_align',
+            'inputs': [wn_dictionary_dir, ox_dictionary_dir, test_data_file],
+            'outputs': [mapping_dir],
+            'resources': ['model']},
+    's07': {'module': 'src.stages.s07_evaluate_models',
+            'inputs': [test_data_file, ox_dictionary_dir, wn_dictionary_dir, mapping_dir],
+            'outputs': [results_file, evaluation_cache_file]},
+    's08': {'module': 'src.stages.s08_final_alignment',
+            'inputs': [wn_dictionary_dir, ox_dictionary_dir],
+            'outputs': [full_alignment_file, full_alignment_state_file],
+            'resources': ['model']},
+    # Compiles the lemma info into the etymology graph s09 and s10 coarsen with, fetching any missing lemmas first; a
+    # graph older than the lemma info is ignored, so this reruns whenever the lemma info changes
+    'graph': {'module': 'src.etymology_graph',
+              'inputs': [ox_lemma_info_dir],
+              'outputs': [etymology_graph_dir],
+              'updates': [ox_lemma_info_dir]},
+    's09': {'module': 'src.stages.s09_compute_homographs',
+            'inputs': [full_alignment_file, full_alignment_state_file, wn_dictionary_dir, ox_dictionary_dir,
+                       ox_lemma_info_dir, etymology_graph_dir],
+            'outputs': [between_pos_pkl_file, within_pos_pkl_file, raw_pkl_file, homographs_state_file],
+            'updates': [ox_lemma_info_dir, coarsener_memo_file]},
+    's10': {'module': 'src.stages.s10_analysis',
+            'inputs': [between_pos_pkl_file, within_pos_pkl_file, raw_pkl_file, wn_dictionary_dir, ox_dictionary_dir,
+                       ox_lemma_info_dir, etymology_graph_dir, wn_synset_counts_file],
+            'outputs': [analysis_json_file, analysis_csv_file],
+            'updates': [ox_lemma_info_dir, coarsener_memo_file]},
+    's11': {'module': 'src.stages.s11_format',
+            'inputs': [between_pos_pkl_file, within_pos_pkl_file, raw_pkl_file],
+            'outputs': [between_pos_csv_file, within_pos_csv_file, raw_csv_file]},
+}
+
+
+def upstream(name):
+    # Stages writing this stage's inputs
+    return [other for other, stage in stages.items() if other != name and
+            set(stage['outputs']) & set(stages[name]['inputs'])]
+
+
+def conflicts(name_1, name_2):
+    touched_1 = set(stages[name_1]['inputs']) | set(stages[name_1]['outputs'])
+    touched_2 = set(stages[name_2]['inputs']) | set(stages[name_2]['outputs'])
+    updates_1 = set(stages[name_1].get('updates', []))
+    updates_2 = set(stages[name_2].get('updates', []))
+    resources_1 = set(stages[name_1].get('resources', []))
+    resources_2 = set(stages[name_2].get('resources', []))
+    return len(updates_1 & touched_2) > 0 or len(updates_2 & touched_1) > 0 or len(resources_1 & resources_2) > 0
+
+
+def signature(name, hasher, stage_args):
+    stage = stages[name]
+    return (tuple((file, hasher.digest(file)) for file in code_files(stage['module'])),
+            tuple((path, hasher.digest(path)) for path in stage['inputs']),
+            stage_args.get(name, ''))
+
+
+def run_stage(name, stage_args):
+    os.makedirs(pipeline_log_dir, exist_ok=True)
+    log_file = os.path.join(pipeline_log_dir, f'{name}.log')
+    command = [sys.executable, '-m', stages[name]['module']] + shlex.split(stage_args.get(name, ''))
+    start = time.time()
+    with open(log_file, 'w') as log:
+        return_code = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT).returncode
+    return return_code, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('targets', nargs='*',
+                        help='Stages to bring up to date, with everything upstream of them; all by default')
+    parser.add_argument('--force', action='store_true', help='Rerun the targets even if they are up to date')
+    parser.add_argument('--workers', type=int, default=2, help='Stages run at once')
+    parser.add_argument('--stage_args', nargs='*', default=[],
+                        help='Extra arguments for a stage, as "name:args", e.g. "s04:--workers 8"')
+    parser.add_argument('--dry_run', action='store_true', help='Only list the stages that are out of date')
+    args = parser.parse_args()
+
+    for name in args.targets:
+        assert name in stages, f'Unknown stage {name}'
+    stage_args = {}
+    for stage_arg in args.stage_args:
+        name, _, arguments = stage_arg.partition(':')
+        assert name in stages, f'Unknown stage {name}'
+        stage_args[name] = arguments
+
+    # The targets and everything upstream of them, in pipeline order
+    targets = set(args.targets) if len(args.targets) > 0 else set(stages.keys())
+    selected = set()
+    queue = list(targets)
+    while len(queue) > 0:
+        name = queue.pop()
+        if name not in selected:
+            selected.add(name)
+            queue.extend(upstream(name))
+    order = [name for name in stages.keys() if name in selected]
+
+    state = open_pickle(pipeline_state_file) if os.path.exists(pipeline_state_file) else {'stages': {}, 'files': {}}
+    hasher = Hasher(state['files'])
+
+    def is_stale(name):
+        if args.force and name in targets:
+            return True
+        if any(not os.path.exists(path) for path in stages[name]['outputs']):
+            return True
+        return state['stages'].get(name) != signature(name, hasher, stage_args)
+
+    if args.dry_run:
+        # Assumes each stale stage changes its outputs, so everything downstream of it reruns too
+        stale = set()
+        for name in order:
+            if is_stale(name) or len(set(upstream(name)) & stale) > 0:
+                stale.add(name)
+        info(f"Out of date: {', '.join(name for name in order if name in stale) or 'nothing'}")
+        save_pickle(pipeline_state_file, state)
+        return
+
+    report = {}  # name -> (status, seconds)
+    pending = list(order)
+    running = {}  # future -> name
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for name in list(pending):
+                if len(running) >= args.workers:
+                    break
+                dependencies = [other for other in upstream(name) if other in selected]
+                if any(report.get(other, ('',))[0] in ['failed', 'blocked'] for other in dependencies):
+                    report[name] = ('blocked', 0.0)
+                    pending.remove(name)
+                    continue
+                if any(other not in report for other in dependencies):
+                    continue
+                if any(conflicts(name, other) for other in running.values()):
+                    continue
+                pending.remove(name)
+                if not is_stale(name):
+                    report[name] = ('up to date', 0.0)
+                    continue
+                info(f"Running {name} ({stages[name]['module']})")
+                running[executor.submit(run_stage, name, stage_args)] = name
+
+            if len(running) == 0:
+                continue
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                return_code, seconds = future.result()
+                if return_code == 0:
+                    # Taken after the run, so inputs the stage updates itself do not make it stale
+                    state['stages'][name] = signature(name, hasher, stage_args)
+                    save_pickle(pipeline_state_file, state)
+                    report[name] = ('ran', seconds)
+                    info(f'Finished {name} in {seconds:.1f}s')
+                else:
+                    state['stages'].pop(name, None)
+                    report[name] = ('failed', seconds)
+                    warn(f'{name} failed with code {return_code}; see {pipeline_log_dir}{name}.log')
+
+    save_pickle(pipeline_state_file, state)
+    info('Stage timings:')
+    for name in order:
+        status, seconds = report[name]
+        info(f'  {name} {status:<10} {seconds:8.1f}s')
+    info(f'Total stage time {sum(seconds for _, seconds in report.values()):.1f}s; logs in {pipeline_log_dir}')
+    if any(status in ['failed', 'blocked'] for status, _ in report.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
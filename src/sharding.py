@@ -0,0 +1,135 @@
+# Split s08 and s09 into shards of words, each runnable on its own (e.g. on other machines sharing the filesystem),
+# and merge the shards' outputs back into the files the serial stages write
+# e.g. for shard in 0 1 2 3; do python -m src.stages.s08_final_alignment --shards 4 --shard $shard; done
+#      python -m src.sharding s08 --shards 4
+import argparse
+import hashlib
+import os
+
+from src.common import open_pickle, save_pickle, info
+from src.global_variables import shard_dir, full_alignment_file, full_alignment_state_file, between_pos_pkl_file, \
+    within_pos_pkl_file, raw_pkl_file, homographs_state_file
+
+
+def add_shard_arguments(parser):
+    parser.add_argument('--shards', type=int, default=1, help='Number of shards the words are split into')
+    parser.add_argument('--shard', type=int, default=None,
+                        help=f'Only process this shard (0 to shards - 1), writing its outputs to {shard_dir} for '
+                             f'python -m src.sharding to merge')
+
+
+def check_shard_arguments(args):
+    if args.shard is None:
+        assert args.shards == 1, '--shards needs --shard'
+    else:
+        assert 0 <= args.shard < args.shards, f'--shard must be between 0 and {args.shards - 1}'
+
+
+def shard_of(word, shards):
+    # Stable across runs and machines, unlike hash(); by word, so all of a word's parts of speech share a shard
+    return int(hashlib.sha1(word.encode('utf-8')).hexdigest()[:8], 16) % shards
+
+
+def in_shard(word, args):
+    return args.shard is None or shard_of(word, args.shards) == args.shard
+
+
+def shard_file(file, shard, shards):
+    # e.g. output/full_alignment.pkl -> output/shards/full_alignment.2-of-4.pkl
+    stem, extension = os.path.splitext(os.path.basename(file))
+    return os.path.join(shard_dir, f'{stem}.{shard}-of-{shards}{extension}')
+
+
+def output_file(file, args):
+    # Where a stage run with args writes file
+    if args.shard is None:
+        return file
+    os.makedirs(shard_dir, exist_ok=True)
+    return shard_file(file, args.shard, args.shards)
+
+
+def open_shards(file, shards):
+    for shard in range(shards):
+        path = shard_file(file, shard, shards)
+        assert os.path.exists(path), f'Missing {path}; run shard {shard} of {shards} first'
+        yield open_pickle(path)
+
+
+def merge_dicts(file, shards):
+    # Shards cover disjoint words, so no key may come from two of them
+    merged = {}
+    for shard_dict in open_shards(file, shards):
+        for key, value in shard_dict.items():
+            assert key not in merged.keys()
+            merged[key] = value
+    return merged
+
+
+def merge_alignment(shards):
+    info(f'Merging {shards} alignment shards')
+    alignment = merge_dicts(full_alignment_file, shards)
+
+    state = None
+    for shard_state in open_shards(full_alignment_state_file, shards):
+        if state is None:
+            state = {'model': shard_state['model'], 'metric': shard_state['metric'], 'code': shard_state['code'],
+                     'digests': {}, 'wn_ids': {}, 'runs': {}}
+        assert (shard_state['model'], shard_state['metric'], shard_state['code']) == \
+            (state['model'], state['metric'], state['code']), 'Shards ran with different models or code'
+        for key, digest in shard_state['digests'].items():
+            assert key not in state['digests'].keys()
+            state['digests'][key] = digest
+        state['wn_ids'].update(shard_state['wn_ids'])
+        state['runs'].update(shard_state['runs'])
+
+    info(f'Saving {len(alignment)} aligned senses')
+    save_pickle(full_alignment_file, alignment)
+    save_pickle(full_alignment_state_file, state)
+
+
+def merge_homographs(shards):
+    info(f'Merging {shards} homograph shards')
+    raw_homographs = merge_dicts(raw_pkl_file, shards)
+
+    # As in s09, no cluster name may be used by two words
+    for file in [within_pos_pkl_file, between_pos_pkl_file]:
+        homographs = {}
+        clusters = set()
+        for shard_homographs in open_shards(file, shards):
+            shard_clusters = set(shard_homographs.values())
+            assert len(shard_clusters & clusters) == 0
+            clusters.update(shard_clusters)
+            for wn_id, cluster in shard_homographs.items():
+                assert wn_id not in homographs.keys()
+                homographs[wn_id] = cluster
+        assert set(homographs.keys()) == set(raw_homographs.keys())
+        info(f'Saving {len(homographs)} senses in {len(clusters)} clusters to {file}')
+        save_pickle(file, homographs)
+
+    state = None
+    for shard_state in open_shards(homographs_state_file, shards):
+        if state is None:
+            state = {'signature': shard_state['signature'], 'digests': {}, 'runs': {}, 'word_wn_ids': {}}
+        assert shard_state['signature'] == state['signature'], 'Shards ran with different lemma info or options'
+        state['digests'].update(shard_state['digests'])
+        state['runs'].update(shard_state['runs'])
+        for word, wn_ids in shard_state['word_wn_ids'].items():
+            assert word not in state['word_wn_ids'].keys()
+            state['word_wn_ids'][word] = wn_ids
+    save_pickle(raw_pkl_file, raw_homographs)
+    save_pickle(homographs_state_file, state)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('stages', nargs='*', default=['s08', 's09'], help='Stages whose shards to merge')
+    parser.add_argument('--shards', type=int, required=True, help='Number of shards the stages ran with')
+    args = parser.parse_args()
+
+    for stage in args.stages:
+        assert stage in ['s08', 's09'], f'Only s08 and s09 are sharded, not {stage}'
+    if 's08' in args.stages:
+        merge_alignment(args.shards)
+    if 's09' in args.stages:
+        merge_homographs(args.shards)
+    info('Done')
@@ -2,8 +2,9 @@
 from collections import defaultdict
 from nltk.corpus import wordnet as wn
 
-from src.common import save_pickle, info, open_pickle
-from src.global_variables import wn_dictionary_file
+from src.columnar_dictionary import save_dictionary
+from src.common import info, open_pickle, save_pickle
+from src.global_variables import wn_dictionary_dir, wn_definitions_file, wn_synset_counts_file
 
 pos_lookup = {
     'n': 'noun',
@@ -14,7 +15,7 @@ pos_lookup = {
 }
 
 info('Loading definitions')
-extracted_definitions = open_pickle('data/definitions.pkl')
+extracted_definitions = open_pickle(wn_definitions_file)
 
 info('Generating dictionary')
 wn_dict = defaultdict(dict)
@@ -65,7 +66,12 @@ for lemma, pos_options in word_pos_options.items():
 
 info(f'Filtered {filtered_num_senses}/{overall_num_senses} senses, leaving {overall_num_senses-filtered_num_senses}')
 
+# Synsets of each remaining word, as wn.synsets counts them (including morphological matches), for s10
+info('Counting synsets')
+synset_counts = {lemma_name: len(wn.synsets(lemma_name)) for (lemma_name, _) in wn_dict.keys()}
+
 info('Saving')
-save_pickle(wn_dictionary_file, wn_dict)
+save_dictionary(wn_dictionary_dir, wn_dict)
+save_pickle(wn_synset_counts_file, synset_counts)
 
 info('Done')
@@ -1,84 +1,86 @@
 # Download the ox data
 import os
-import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import requests
-
-from src.common import open_pickle, save_pickle, info, get_credentials
-from src.global_variables import per_minute_requests, ox_download_dir, wn_dictionary_file, ox_processed_file
+from src.columnar_dictionary import load_dictionary
+from src.common import open_pickle, info, warn, get_credentials
+from src.global_variables import per_minute_requests, ox_download_dir, wn_dictionary_dir, ox_processed_file, \
+    download_workers, legacy_ox_processed_file, ox_store_file
+from src.ox_requestor import OxRequestor
+from src.ox_store import OxStore
+from src.progress_journal import ProgressJournal
 
 app_id, key = get_credentials()
 
 
-class Requestor:
-    def __init__(self):
-        self.num_requests = 0
-        self.time = datetime.now()
-        self.repeat_time = 61
+def download_word(word):
+    # First get the word
+    url = requestor.url_base + f"/words/?lemma={word.lower()}"
+    parsed_data = requestor.request(url)
 
-    def request(self, url):
-        if self.num_requests >= per_minute_requests:
-            # Max requests reached
-            time_now = datetime.now()
-            time_diff = (self.time - time_now).total_seconds() + 60
-            if time_diff > 0:
-                time.sleep(time_diff)
-            # Reset
-            self.time = datetime.now()
-            self.num_requests = 0
+    ids = {datapoint['id'] for datapoint in parsed_data['data']}
 
-        parsed_data = requests.get(url, headers={"app_id": app_id, "app_key": key}).json()
-        self.num_requests += 1
-        return parsed_data
+    if len(ids) > 0:
+        # Save the word
+        store.put_word(word, parsed_data)
 
+        # Now, get and save all entries; entries shared between words are only fetched once
+        for id in ids:
+            if id not in journal.entries and not store.has_entry(id):
+                url = requestor.url_base + f"/word/{id}/senses/"
+                requestor.request_shared(url, handle=lambda data, id=id: save_entry(id, data))
 
-if not os.path.exists(ox_processed_file):
-    save_pickle(ox_processed_file, set())
+    return word
 
-info('Loading words')
-words = {word for (word, pos) in open_pickle(wn_dictionary_file).keys()}
-words_processed = open_pickle(ox_processed_file)
-words_to_do = (words.difference(words_processed))
 
-info(f'{len(words)} words total ({len(words_processed)} done; {len(words_to_do)} remain)')
+def save_entry(id, data):
+    store.put_entry(id, data)
+    journal.add_entry(id)
 
-requestor = Requestor()
-url_base = "https://oed-researcher-api.oxfordlanguages.com/oed/api/v0.2"
 
-info(f'Downloading with key {key}')
-processed = 0
-while len(words_to_do) > 0:
+os.makedirs(ox_download_dir, exist_ok=True)
+store = OxStore(ox_store_file)
+if not store.imported_pickle_tree() and os.path.isdir(ox_download_dir + 'words'):
+    info('Packing previously downloaded pickles into the store')
+    info(f'Imported {store.import_pickle_tree(ox_download_dir)} files; {ox_download_dir}words and '
+         f'{ox_download_dir}entries can now be removed')
 
-    if processed % 100 == 0 and processed > 0:
-        info(f'{processed} words processed...')
+journal = ProgressJournal(ox_processed_file)
+if os.path.exists(legacy_ox_processed_file):
+    info('Importing legacy processed words into the journal')
+    journal.seed(open_pickle(legacy_ox_processed_file))
+    os.remove(legacy_ox_processed_file)
 
-    # First get the word
-    word = words_to_do.pop(0)
-    url = url_base + f"/words/?lemma={word.lower()}"
-    parsed_data = requestor.request(url)
+info('Loading words')
+words = {word for (word, pos) in load_dictionary(wn_dictionary_dir).keys()}
+words_processed = journal.words
+words_to_do = sorted(words.difference(words_processed))
 
-    ids = {datapoint['id'] for datapoint in parsed_data['data']}
+info(f'{len(words)} words total ({len(words_processed)} done; {len(words_to_do)} remain)')
 
-    if len(ids) > 0:
-        # Save the word
-        letter = word[0].lower()
-        dir = ox_download_dir + 'words/' + letter
-        os.makedirs(dir, exist_ok=True)
-        save_pickle(dir + f'/{word}.pkl', parsed_data)
+requestor = OxRequestor(app_id, key, per_minute_requests, workers=download_workers)
 
-        # Now, get and save all entries
-        for id in ids:
-            dir = ox_download_dir + 'entries/' + id[0].lower()
-            path = dir + f'/{id}.pkl'
-            if not os.path.exists(path):
-                url = url_base + f"/word/{id}/senses/"
-                os.makedirs(dir, exist_ok=True)
-                parsed_data = requestor.request(url)
-                save_pickle(path, parsed_data)
-
-    processed += 1
-    words_processed.add(word)
-    save_pickle(ox_processed_file, words_processed)
+info(f'Downloading with key {key} over {download_workers} workers')
+processed = 0
+with ThreadPoolExecutor(max_workers=download_workers) as executor:
+    futures = {executor.submit(download_word, word): word for word in words_to_do}
+    for future in as_completed(futures):
+        try:
+            word = future.result()
+        except Exception as e:
+            # Left unprocessed, so it is retried on the next run
+            warn(f'Failed to download {futures[future]}: {e}')
+            continue
+
+        processed += 1
+        if processed % 100 == 0:
+            info(f'{processed} words processed...')
+
+        journal.add_word(word)
+
+info('Compacting journal')
+journal.compact()
+journal.close()
+store.close()
 
 info(f'Done.')
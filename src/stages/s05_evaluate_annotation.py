@@ -2,16 +2,17 @@ from collections import defaultdict
 
 from sklearn.metrics import cohen_kappa_score
 
-from src.common import open_dict_csv, info, open_pickle
-from src.global_variables import annotator_1_alignment_file, ox_dictionary_file, wn_dictionary_file, \
+from src.columnar_dictionary import load_dictionary
+from src.common import open_dict_csv, info
+from src.global_variables import annotator_1_alignment_file, ox_dictionary_dir, wn_dictionary_dir, \
     annotator_2_alignment_file, test_alignment_file
-from src.homograph_coarsener_v1 import HomographCoarsenerV1
+from src.homograph_coarsener_v2 import HomographCoarsenerV2
 
 annotator_1 = sorted(open_dict_csv(annotator_1_alignment_file), key=lambda d: f"{d['word']}:{d['pos']}:{d['wn_id']}")
 annotator_2 = sorted(open_dict_csv(annotator_2_alignment_file), key=lambda d: f"{d['word']}:{d['pos']}:{d['wn_id']}")
 
-ox_dict = open_pickle(ox_dictionary_file)
-wn_dict = open_pickle(wn_dictionary_file)
+ox_dict = load_dictionary(ox_dictionary_dir)
+wn_dict = load_dictionary(wn_dictionary_dir)
 
 # % Agreements
 sense_percent = sum([anno1['ox_id'] == anno2['ox_id'] for (anno1, anno2) in zip(annotator_1, annotator_2)]) / len(annotator_1)
@@ -54,14 +55,17 @@ lemma_preds_2 = []
 sense_preds_1 = []
 sense_preds_2 = []
 
-hc = HomographCoarsenerV1()
+hc = HomographCoarsenerV2()
+word_lemmas = [list({entry['coarse_lemma_id'] for entry in ox_dict[(word, pos)].values()})
+               for (word, pos) in anno1_datapoints.keys()]
+word_homographs = hc.coarsen_many(word_lemmas)
 
-for (word, pos) in anno1_datapoints.keys():
+for (word, pos), homographs in zip(anno1_datapoints.keys(), word_homographs):
     a1d = anno1_datapoints[(word, pos)]
     a2d = anno2_datapoints[(word, pos)]
     ox_senses = set(ox_dict[(word, pos)].keys())
     ox_senses.add('')
-    ox_lemmas = set(hc.coarsen_homographs(list({entry['coarse_lemma_id'] for entry in ox_dict[(word, pos)].values()})))
+    ox_lemmas = set(homographs)
     ox_lemmas.add('')
 
     lemma1s = []
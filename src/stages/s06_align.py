@@ -1,46 +1,54 @@
 # Compute an alignment between wn and ox for the test items
+import argparse
+import gc
 from collections import defaultdict
 
 import numpy as np
-from sentence_transformers import SentenceTransformer, util
-from sklearn.metrics.pairwise import euclidean_distances
+import torch
+from sentence_transformers import SentenceTransformer
 
-from string import punctuation
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-from nltk.stem import WordNetLemmatizer
+from src.alignment_scoring import segment_scores, stack_segments, segment_offsets
+from src.columnar_dictionary import load_dictionary
 from src.common import save_pickle, info, open_pickle, warn
-from src.global_variables import mapping_dir, wn_dictionary_file, ox_dictionary_file, test_data_file
-
-lemmatizer = WordNetLemmatizer()
-
-info('Initialising sentence embedding models')
+from src.embedding_cache import EmbeddingCache
+from src.global_variables import mapping_dir, wn_dictionary_dir, ox_dictionary_dir, test_data_file, \
+    encode_batch_size
+from src.lesk import LeskEngine
 
 model_names = ['all-mpnet-base-v2', 'average_word_embeddings_glove.6B.300d', 'all-roberta-large-v1',
                'gtr-t5-xxl', 'sentence-t5-xxl']
-models = [(m, SentenceTransformer(m)) for m in model_names]
 
-similarity_metrics = [('cosine', lambda a, b: util.cos_sim(a, b).numpy()),
-                      ('dot_prod', lambda a, b: util.dot_score(a, b).numpy()),
-                      ('euc_dist', lambda a, b: -euclidean_distances(a, b))]
+parser = argparse.ArgumentParser()
+parser.add_argument('--models', nargs='*', choices=model_names, default=model_names,
+                    help='Sentence embedding models to align with, loaded one at a time')
+parser.add_argument('--skip_baselines', action='store_true', help='Do not compute the random, majority and LESK '
+                                                                  'baselines')
+args = parser.parse_args()
 
 
-def tokens_sentence(sentence):
-    return {lemmatizer.lemmatize(w.lower()) for w in word_tokenize(sentence)
-            if w.lower() not in stopwords.words('english') and w.lower() not in set(punctuation)}
+def add_alignments(alignments, model_name, item, sims):
+    subset_name = model_name.split(':')[-1]
+    ox_ids = item['ox_infos'][subset_name]['ox_ids']
+    for wn_id, similarity in zip(item['wn_ids'], sims):
+        best = ox_ids[np.argmax(similarity)]
 
+        assert wn_id not in alignments[model_name].keys()
+        alignments[model_name][wn_id] = best
 
-info('Loading dictionaries')
-wn_dict = open_pickle(wn_dictionary_file)
-ox_dict = open_pickle(ox_dictionary_file)
-test_items = set(open_pickle(test_data_file).keys())
-alignments = defaultdict(dict)
 
-info('Aligning...')
-for j, (word, pos), in enumerate(test_items):
+def save_alignments(alignments):
+    for model_name, alignment in alignments.items():
+        save_pickle(mapping_dir + f'{model_name}.pkl', alignment)
+
+
+info('Loading dictionaries')
+wn_dict = load_dictionary(wn_dictionary_dir)
+ox_dict = load_dictionary(ox_dictionary_dir)
+test_items = sorted(open_pickle(test_data_file).keys())
 
-    if j % 10 == 0:
-        info(f'On word {j + 1}/{len(test_items)}')
+info('Collecting test items')
+items = []
+for (word, pos) in test_items:
 
     if (word, pos) not in wn_dict.keys():
         warn(f"{word} ({pos}) for in WordNet keys")
@@ -51,70 +59,99 @@ for j, (word, pos), in enumerate(test_items):
         continue
 
     wn_senses = wn_dict[(word, pos)].values()
-    wn_poses = [defn['pos'] for defn in wn_senses]
-    wn_ids = [defn['id'] for defn in wn_senses]
-    wn_defs = [defn['definition'] for defn in wn_senses]
+    ox_senses = list(ox_dict[(word, pos)].values())
 
-    ox_sense_subsets = [('only_mains', [s for s in ox_dict[(word, pos)].values() if s['main']]),
-                        ('all', ox_dict[(word, pos)].values())]
+    ox_sense_subsets = [('only_mains', [s for s in ox_senses if s['main']]),
+                        ('all', ox_senses)]
 
-    ox_infos = {subset_name: {
-        'ox_poses': [defn['pos'] for defn in ox_senses],
+    items.append({
+        'wn_ids': [defn['id'] for defn in wn_senses],
+        'wn_defs': [defn['definition'] for defn in wn_senses],
         'ox_ids': [defn['id'] for defn in ox_senses],
         'ox_defs': [defn['definition'] for defn in ox_senses],
-        'clusters': [defn['homograph_cluster_v1'] for defn in ox_senses]
-    } for (subset_name, ox_senses) in ox_sense_subsets}
-
-    similarities = {}
-
-    # First do all models
-    for model_name, model in models:
-        wn_embeddings = model.encode(wn_defs)
-        for subset_name in ox_infos.keys():
-            ox_defs = ox_infos[subset_name]['ox_defs']
-            ox_embeddings = model.encode(ox_defs)
-            for metric_name, metric in similarity_metrics:
-                # Calculate similarities; all are shape |WN| x |OX|
-                similarities[f'{model_name}:{metric_name}:{subset_name}'] = metric(wn_embeddings, ox_embeddings)
-
-    # Now do baselines
-    for subset_name in ox_infos.keys():
-        ox_defs = ox_infos[subset_name]['ox_defs']
-        similarities[f'random:{subset_name}'] = np.random.rand(len(wn_defs), len(ox_defs))
-
-        # Now do majority
-        clusters = ox_infos[subset_name]['clusters']
-        cluster_count = defaultdict(int)
-        for cluster in clusters:
-            cluster_count[cluster] += 1
-        similarities[f'majority:{subset_name}'] = np.repeat(np.expand_dims(
-            np.array([cluster_count[cluster] for cluster in clusters]), 0), len(wn_defs), 0)
-
-        # Now do LESK
-        ox_defs_toks = [tokens_sentence(sentence) for sentence in ox_defs]
-        lesk_similarities = []
-        for defn in wn_defs:
-            sims = []
-            wn_toks = tokens_sentence(defn)
-            for ox_toks in ox_defs_toks:
-                sims.append(len(wn_toks.intersection(ox_toks)) / min(len(wn_toks), len(ox_toks)))
-
-            lesk_similarities.append(sims)
-        similarities[f'lesk:{subset_name}'] = np.array(lesk_similarities)
-
-    for model_name, sims in similarities.items():
-        for wn_pos, wn_id, similarity in zip(wn_poses, wn_ids, sims):
-            subset_name = model_name.split(':')[-1]
-            ox_poses = ox_infos[subset_name]['ox_poses']
-            ox_ids = ox_infos[subset_name]['ox_ids']
-
-            best = ox_ids[np.argmax(similarity)]
-
-            assert wn_id not in alignments[model_name].keys()
-            alignments[model_name][wn_id] = best
-
-info('Saving')
-for model_name, alignment in alignments.items():
-    save_pickle(mapping_dir + f'{model_name}.pkl', alignment)
+        'ox_mains': [defn['main'] for defn in ox_senses],
+        'ox_infos': {subset_name: {
+            'ox_ids': [defn['id'] for defn in subset_senses],
+            'ox_defs': [defn['definition'] for defn in subset_senses],
+            'clusters': [defn['homograph_cluster_v1'] for defn in subset_senses]
+        } for (subset_name, subset_senses) in ox_sense_subsets}
+    })
+
+# Subsets are masks over the full set of senses, so only the full set needs embedding
+all_wn_ids = [wn_id for item in items for wn_id in item['wn_ids']]
+all_ox_ids = [ox_id for item in items for ox_id in item['ox_ids']]
+ox_subset_masks = [('only_mains', np.array([main for item in items for main in item['ox_mains']], dtype=bool)),
+                   ('all', None)]
+
+# Run model by model, so only one is resident at a time
+for model_name in args.models:
+
+    info(f'Initialising {model_name}')
+    model = SentenceTransformer(model_name)
+    cache = EmbeddingCache(model_name)
+
+    all_defs = set()
+    for item in items:
+        all_defs.update(item['wn_defs'])
+        all_defs.update(item['ox_defs'])
+    embeddings, def_rows = cache.encode_corpus(model, all_defs, batch_size=encode_batch_size)
+
+    info(f'Aligning with {model_name}...')
+    wn_rows, wn_offsets = stack_segments([[def_rows[defn] for defn in item['wn_defs']] for item in items])
+    ox_rows, ox_offsets = stack_segments([[def_rows[defn] for defn in item['ox_defs']] for item in items])
+    alignments = defaultdict(dict)
+    for subset_name, ox_mask in ox_subset_masks:
+        ranked = segment_scores(embeddings[wn_rows], embeddings[ox_rows], wn_offsets, ox_offsets, ox_mask=ox_mask)
+        for metric_name, best_rows in ranked.items():
+            alignment = alignments[f'{model_name}:{metric_name}:{subset_name}']
+            for wn_id, best_row in zip(all_wn_ids, best_rows[:, 0]):
+                assert wn_id not in alignment.keys()
+                alignment[wn_id] = all_ox_ids[best_row]
+
+    info(f'Saving {model_name}')
+    save_alignments(alignments)
+
+    # Free the model before loading the next
+    cache.close()
+    del model, cache, embeddings
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+if not args.skip_baselines:
+
+    info('Computing baselines...')
+    alignments = defaultdict(dict)
+    for item in items:
+        wn_defs = item['wn_defs']
+
+        for subset_name, ox_info in item['ox_infos'].items():
+            ox_defs = ox_info['ox_defs']
+            add_alignments(alignments, f'random:{subset_name}', item, np.random.rand(len(wn_defs), len(ox_defs)))
+
+            # Now do majority
+            clusters = ox_info['clusters']
+            cluster_count = defaultdict(int)
+            for cluster in clusters:
+                cluster_count[cluster] += 1
+            add_alignments(alignments, f'majority:{subset_name}', item, np.repeat(np.expand_dims(
+                np.array([cluster_count[cluster] for cluster in clusters]), 0), len(wn_defs), 0))
+
+    # Now do LESK, over all items at once
+    lesk = LeskEngine()
+    all_wn_defs = [defn for item in items for defn in item['wn_defs']]
+    all_ox_defs = [defn for item in items for defn in item['ox_defs']]
+    wn_offsets = segment_offsets([item['wn_defs'] for item in items])
+    ox_offsets = segment_offsets([item['ox_defs'] for item in items])
+    for subset_name, ox_mask in ox_subset_masks:
+        best_rows = lesk.best_matches(all_wn_defs, all_ox_defs, wn_offsets, ox_offsets, ox_mask=ox_mask)
+        alignment = alignments[f'lesk:{subset_name}']
+        for wn_id, best_row in zip(all_wn_ids, best_rows):
+            assert wn_id not in alignment.keys()
+            alignment[wn_id] = all_ox_ids[best_row]
+    lesk.save()
+
+    info('Saving baselines')
+    save_alignments(alignments)
 
 info('Done')
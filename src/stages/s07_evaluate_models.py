@@ -1,153 +1,186 @@
-# Eval the quality of each alignment in the alignments folder
+# Eval the quality of each alignment in the alignments folder; results are cached per alignment file, so only new or
+# changed alignments are scored
+import argparse
 import glob
+import hashlib
 import itertools
 import os
-import random
 from collections import defaultdict
+from multiprocessing import Pool
 
 import numpy as np
-from sklearn.metrics import adjusted_mutual_info_score, f1_score, accuracy_score
 
-from src.common import open_pickle, info, warn, flatten, save_csv
-from src.global_variables import ox_dictionary_file, test_data_file, mapping_dir, wn_dictionary_file, \
-    results_file
-
-random.seed(0)
+from src.columnar_dictionary import load_dictionary
+from src.common import open_pickle, info, warn, flatten, save_csv, save_pickle
+from src.evaluation_engine import SegmentedLabels, encode_labels
+from src.global_variables import ox_dictionary_dir, test_data_file, mapping_dir, wn_dictionary_dir, \
+    results_file, evaluation_cache_file
+from src.hashing import Hasher, code_files
+from src.permutation_test import significance_many
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--workers', type=int, default=1,
+                    help='Processes scoring alignments and running the significance tests')
+parser.add_argument('--seed', type=int, default=0, help='Seed for the significance test permutations')
+parser.add_argument('--permutations', type=int, default=10000, help='Most permutations per significance test')
+parser.add_argument('--sequential', action='store_true',
+                    help='Stop each significance test once it is clearly decided at p <= 0.01')
+parser.add_argument('--full', action='store_true', help='Rescore every alignment, ignoring cached results')
+args = parser.parse_args()
 
 info('Loading data')
 test_clusters = open_pickle(test_data_file)
-ox_dict = open_pickle(ox_dictionary_file)
-wn_dict = open_pickle(wn_dictionary_file)
-
-info('Loading alignments')
-alignments = {}
+ox_dict = load_dictionary(ox_dictionary_dir)
+wn_dict = load_dictionary(wn_dictionary_dir)
+
+info('Collecting test data')
+test_words = []  # ((word, pos), [(wn sense id, datapoint)])
+for (word, pos), datapoints in test_clusters.items():
+    if (word, pos) not in wn_dict.keys() or (word, pos) not in ox_dict.keys():
+        warn(f'({word}, {pos}) missing')
+        continue
+    if len(datapoints) == 0:
+        continue
+    test_words.append(((word, pos), list(datapoints.items())))
+
+
+def segment(words, keep):
+    # The kept items of every word, flattened, and the offsets of the words left with any
+    words = [[item for item in items if keep(item)] for items in words]
+    words = [items for items in words if len(items) > 0]
+    return flatten(words), np.cumsum([0] + [len(items) for items in words])
+
+
+def score_models(model_files):
+    # {model name: {'results', 'lemmas', 'true_lemmas', 'senses', 'true_senses'}} for the alignments in model_files
+    alignments = {}
+    for model_name, file in model_files:
+        alignments[model_name] = open_pickle(file)
+
+    # Models aligning the same test senses share their gold labels, so are scored together
+    model_groups = defaultdict(list)
+    for model_name, alignment in alignments.items():
+        missing = []
+        for _, datapoints in test_words:
+            for wn_sense_id, _ in datapoints:
+                if wn_sense_id not in alignment.keys():
+                    warn(f'{wn_sense_id} missing from alignment {model_name}')
+                    missing.append(wn_sense_id)
+        model_groups[tuple(missing)].append(model_name)
+
+    evaluations = {model_name: {'results': {}} for model_name in alignments.keys()}
+    cluster_of = {}  # ((word, pos), ox sense id) -> homograph cluster
+    for missing, model_names in model_groups.items():
+        missing = set(missing)
+
+        # Items are ((word, pos), wn sense id, correct ox sense id, correct cluster)
+        words = [[((word, pos), wn_sense_id, datapoint['ox_id'], datapoint['cluster'])
+                  for wn_sense_id, datapoint in datapoints if wn_sense_id not in missing]
+                 for (word, pos), datapoints in test_words]
+        cluster_sets = [('unfiltered', segment(words, lambda item: True)),
+                        ('filtered', segment(words, lambda item: item[3] != ''))]
+        sense_items, sense_offsets = segment(words, lambda item: item[2] != '')
+
+        # Cluster results
+        scores = {}
+        for name, (items, offsets) in cluster_sets:
+            predicted_clusters = []
+            for model_name in model_names:
+                predicted_clusters.append([])
+                for (key, wn_sense_id, _, _) in items:
+                    predicted_ox_sense_id = alignments[model_name][wn_sense_id]
+                    if (key, predicted_ox_sense_id) not in cluster_of.keys():
+                        cluster_of[(key, predicted_ox_sense_id)] = \
+                            ox_dict[key][predicted_ox_sense_id]['homograph_cluster_v1']
+                    predicted_clusters[-1].append(cluster_of[(key, predicted_ox_sense_id)])
+            correct_clusters = [item[3] for item in items]
+            gold, *predictions = encode_labels([correct_clusters] + predicted_clusters, {})
+            scores[name] = SegmentedLabels(gold, offsets).scores(predictions)
+
+            if name == 'unfiltered':
+                for model_name, clusters in zip(model_names, predicted_clusters):
+                    evaluations[model_name]['lemmas'] = clusters
+                    evaluations[model_name]['true_lemmas'] = correct_clusters
+
+        # Sense results
+        predicted_senses = [[alignments[model_name][item[1]] for item in sense_items] for model_name in model_names]
+        correct_senses = [item[2] for item in sense_items]
+        gold, *predictions = encode_labels([correct_senses] + predicted_senses, {})
+        scores['sense'] = SegmentedLabels(gold, sense_offsets).scores(predictions)
+        for model_name, senses in zip(model_names, predicted_senses):
+            evaluations[model_name]['senses'] = senses
+            evaluations[model_name]['true_senses'] = correct_senses
+
+        for index, model_name in enumerate(model_names):
+            results = evaluations[model_name]['results']
+            for name, _ in cluster_sets:
+                for level in ['micro', 'macro']:
+                    results[f'{level}_ami_{name}'] = float(scores[name][f'{level}_ami'][index])
+                    results[f'{level}_cluster_acc_{name}'] = float(scores[name][f'{level}_acc'][index])
+                    results[f'{level}_cluster_f1_{name}'] = float(scores[name][f'{level}_f1'][index])
+            for level in ['micro', 'macro']:
+                results[f'{level}_sense_acc'] = float(scores['sense'][f'{level}_acc'][index])
+                results[f'{level}_sense_f1'] = float(scores['sense'][f'{level}_f1'][index])
+    return evaluations
+
+
+info('Hashing alignments')
+cache = {'files': {}, 'evaluations': {}}
+if os.path.exists(evaluation_cache_file):
+    cache = open_pickle(evaluation_cache_file)
+hasher = Hasher(cache['files'])
+
+# Cached results are reused while the alignment, the gold data and the scoring code are all unchanged
+gold_digest = hashlib.sha1()
+for path in [test_data_file, ox_dictionary_dir, wn_dictionary_dir] + code_files('src.stages.s07_evaluate_models'):
+    gold_digest.update(f'{hasher.digest(path)}\n'.encode())
+gold_digest = gold_digest.hexdigest()
+
+model_files = []  # (model name, file, cache key)
 for file in glob.iglob(mapping_dir + '*.pkl'):
     model_name = '.'.join(os.path.basename(file).split('.')[:-1])
-    alignments[model_name] = open_pickle(file)
+    model_files.append((model_name, file, (hasher.digest(file), gold_digest)))
 
-results = defaultdict(dict)
+evaluations = {}
+unscored = []
+for model_name, file, key in model_files:
+    if not args.full and key in cache['evaluations'].keys():
+        evaluations[model_name] = cache['evaluations'][key]
+    else:
+        unscored.append((model_name, file))
+info(f'Scoring {len(unscored)} new or changed alignments, {len(evaluations)} cached')
+
+if len(unscored) > 0:
+    # Models are split evenly over the workers, and each worker scores its share together
+    chunks = [unscored[i::args.workers] for i in range(min(args.workers, len(unscored)))]
+    if len(chunks) == 1:
+        chunk_evaluations = [score_models(chunks[0])]
+    else:
+        with Pool(len(chunks)) as pool:
+            chunk_evaluations = pool.map(score_models, chunks)
+    for chunk_evaluation in chunk_evaluations:
+        evaluations.update(chunk_evaluation)
+
+# Only the current alignments are kept in the cache
+cache['evaluations'] = {key: evaluations[model_name] for model_name, _, key in model_files}
+save_pickle(evaluation_cache_file, cache)
+
+results = {}
 outputs_lemmas = dict()
 outputs_senses = dict()
-
-info(f'Computing results')
-for model_name, alignment in alignments.items():
-    cluster_index = 0
-
-    # Lists of lists
-    all_correct_clusterings = []
-    all_pred_clusterings = []
-    all_correct_ids = []
-    all_pred_ids = []
-
-    for (word, pos), datapoints in test_clusters.items():
-        if (word, pos) not in wn_dict.keys() or (word, pos) not in ox_dict.keys():
-            warn(f'({word}, {pos}) missing')
-            continue
-
-        wn_sense_ids = []
-        predicted_ox_sense_ids = []
-        correct_ox_sense_ids = []
-        predicted_clusters = []
-        correct_clusters = []
-
-        if len(datapoints) == 0:
-            continue
-
-        for wn_sense_id, datapoint in datapoints.items():
-
-            if wn_sense_id in alignment.keys():
-                predicted_ox_sense_id = alignment[wn_sense_id]
-                predicted_ox_sense_ids.append(predicted_ox_sense_id)
-
-                correct_ox_sense_id = datapoint['ox_id']
-                correct_ox_sense_ids.append(correct_ox_sense_id)
-
-                correct_cluster = datapoint['cluster']
-                predicted_cluster = ox_dict[(word, pos)][predicted_ox_sense_id]['homograph_cluster_v1']
-                predicted_clusters.append(predicted_cluster)
-                correct_clusters.append(correct_cluster)
-            else:
-                warn(f'{wn_sense_id} missing from alignment {model_name}')
-
-        # If the prediction is in the correct options, make that the correct one, otherwise choose randomly
-        # Filter unlabelled
-        corr_pred = [(c, p) for (c, p) in zip(correct_ox_sense_ids, predicted_ox_sense_ids) if c != '']
-        if len(corr_pred) > 0:
-            correct_ox_sense_ids, predicted_ox_sense_ids = zip(*corr_pred)
-            all_correct_ids.append(correct_ox_sense_ids)
-            all_pred_ids.append(predicted_ox_sense_ids)
-
-        # Skip any which have only a single homograph after removing excluded
-        ox_definitions = ox_dict[(word, pos)].values()
-        all_correct_clusterings.append(correct_clusters)
-        all_pred_clusterings.append(predicted_clusters)
-
-    # Filter data
-    all_correct_clusterings_filtered = []
-    all_pred_clusterings_filtered = []
-    for correct_cluster, pred_cluster in zip(all_correct_clusterings, all_pred_clusterings):
-        correct_filtered = []
-        pred_filtered = []
-        for c, p in zip(correct_cluster, pred_cluster):
-            if c != '':
-                correct_filtered.append(c)
-                pred_filtered.append(p)
-        assert len(correct_filtered) == len(pred_filtered)
-        if len(correct_filtered) > 0:
-            all_correct_clusterings_filtered.append(correct_filtered)
-            all_pred_clusterings_filtered.append(pred_filtered)
-
-    sets = [(all_correct_clusterings, all_pred_clusterings, 'unfiltered'),
-            (all_correct_clusterings_filtered, all_pred_clusterings_filtered, 'filtered')]
-
-    # Save output
-    outputs_lemmas[model_name] = flatten(all_pred_clusterings)
+for model_name, _, _ in model_files:
+    evaluation = evaluations[model_name]
+    results[model_name] = dict(evaluation['results'])
+    outputs_lemmas[model_name] = evaluation['lemmas']
     if 'true' in outputs_lemmas.keys():
-        assert outputs_lemmas['true'] == flatten(all_correct_clusterings)
+        assert outputs_lemmas['true'] == evaluation['true_lemmas']
     else:
-        outputs_lemmas['true'] = flatten(all_correct_clusterings)
-    outputs_senses[model_name] = flatten(all_pred_ids)
+        outputs_lemmas['true'] = evaluation['true_lemmas']
+    outputs_senses[model_name] = evaluation['senses']
     if 'true' in outputs_senses.keys():
-        assert outputs_senses['true'] == flatten(all_correct_ids)
+        assert outputs_senses['true'] == evaluation['true_senses']
     else:
-        outputs_senses['true'] = flatten(all_correct_ids)
-
-    # Cluster results
-    for (correct, predicted, name) in sets:
-        results[model_name][f'micro_ami_{name}'] = np.mean(
-            [adjusted_mutual_info_score(correct_cluster, predicted_cluster) for (correct_cluster, predicted_cluster)
-             in zip(correct, predicted)])
-        results[model_name][f'micro_cluster_acc_{name}'] = np.mean(
-            [accuracy_score(correct_cluster, predicted_cluster) for (correct_cluster, predicted_cluster) in
-             zip(correct, predicted)])
-        results[model_name][f'micro_cluster_f1_{name}'] = np.mean(
-            [f1_score(correct_cluster, predicted_cluster, average='weighted') for
-             (correct_cluster, predicted_cluster) in zip(correct, predicted)])
-
-        correct_clusters_flattened = flatten(correct)
-        pred_clusters_flattened = flatten(predicted)
-
-        results[model_name][f'macro_ami_{name}'] = adjusted_mutual_info_score(
-            correct_clusters_flattened, pred_clusters_flattened)
-        results[model_name][f'macro_cluster_acc_{name}'] = accuracy_score(correct_clusters_flattened,
-                                                                                      pred_clusters_flattened)
-        results[model_name][f'macro_cluster_f1_{name}'] = f1_score(correct_clusters_flattened,
-                                                                               pred_clusters_flattened,
-                                                                               average='weighted')
-
-    # Sense results
-    correct_senses_flattened = flatten(all_correct_ids)
-    pred_senses_flattened = flatten(all_pred_ids)
-    results[model_name][f'micro_sense_acc'] = np.mean(
-        [accuracy_score(correct_senses, predicted_senses) for (correct_senses, predicted_senses) in
-         zip(all_correct_ids, all_pred_ids)])
-    results[model_name][f'micro_sense_f1'] = np.mean(
-        [f1_score(correct_senses, predicted_senses, average='weighted') for (correct_senses, predicted_senses)
-         in zip(all_correct_ids, all_pred_ids)])
-    results[model_name][f'macro_sense_acc'] = accuracy_score(correct_senses_flattened,
-                                                                         pred_senses_flattened)
-    results[model_name][f'macro_sense_f1'] = f1_score(correct_senses_flattened,
-                                                                  pred_senses_flattened, average='weighted')
+        outputs_senses['true'] = evaluation['true_senses']
 
 info('Printing and saving')
 model_name_map = {
@@ -178,54 +211,27 @@ save_csv(results_file, results_list)
 info('Significance')
 
 
-def significance(assignments_1, assignments_2, correct, metric, r=10000):
-    assert len(assignments_1) == len(assignments_2)
-    assert len(assignments_2) == len(correct)
-    length = len(correct)
-
-    def evaluate_diff(ass_1, ass_2):
-        result_1 = metric(correct, ass_1)
-        result_2 = metric(correct, ass_2)
-        return np.abs(result_1 - result_2)
-
-    observed_diff = evaluate_diff(assignments_1, assignments_2)
-
-    s = 0  # s is number of times the difference is greater that observed
-
-    for i in range(r):
-
-        # Shuffle
-        shuffled_1, shuffled_2 = zip(
-            *[(a, b) if bool(random.getrandbits(1)) else (b, a) for (a, b) in zip(assignments_1, assignments_2)])
-        assert len(shuffled_1) == length
-        assert len(shuffled_2) == length
-        shuffled_diff = evaluate_diff(shuffled_1, shuffled_2)
-
-        if shuffled_diff >= observed_diff:
-            s += 1
-
-    p = (s + 1) / (r + 1)
-    return p
-
-
-acc_metric = lambda corr, pred: accuracy_score(corr, pred)
-f1_metric = lambda corr, pred: f1_score(corr, pred, average='weighted')
-metrics = [('f1', f1_metric), ('acc', acc_metric)]
 datasets = [('sense', outputs_senses), ('lemma', outputs_lemmas)]
 
+# Collect every test first, so they can be spread over processes
+tests = []
+descriptions = []
 for data_name, data in datasets:
     perfect = [(k if k != '' else 'wrong') for k in data['true']]
-    p = significance(data['sentence-t5-xxl:cosine:all'], perfect, data['true'], acc_metric)
-    sig = p <= 0.01
-    info(f'Difference in {data_name} between Sentence-T5 and perfect under acc ' + (
-        'significant' if sig else 'INsignificant') + f' (p={p})')
+    tests.append((data['sentence-t5-xxl:cosine:all'], perfect, data['true'], 'acc'))
+    descriptions.append(f'Difference in {data_name} between Sentence-T5 and perfect under acc')
 
 for ((model_key_1, name_1), (model_key_2, name_2)) in itertools.combinations(list(model_name_map.items()), 2):
     if {name_1, name_2} not in [{'Sentence-T5', 'RoBERTa'}, {'GloVe', 'LESK'}, {'Sentence-T5', 'MPNet'}, {'Sentence-T5', 'GloVe'}]:
         continue
     for data_name, data in datasets:
-        for metric_name, metric in metrics:
-            p = significance(data[model_key_1], data[model_key_2], data['true'], metric)
-            sig = p <= 0.01
-            info(f'Difference in {data_name} between {name_1} and {name_2} under {metric_name} ' + (
-                'significant' if sig else 'INsignificant') + f' (p={p})')
+        for metric_name in ['f1', 'acc']:
+            tests.append((data[model_key_1], data[model_key_2], data['true'], metric_name))
+            descriptions.append(f'Difference in {data_name} between {name_1} and {name_2} under {metric_name}')
+
+significance_threshold = 0.01
+p_values = significance_many(tests, r=args.permutations, seed=args.seed,
+                             alpha=significance_threshold if args.sequential else None, workers=args.workers)
+for description, (p, permutations) in zip(descriptions, p_values):
+    sig = p <= significance_threshold
+    info(f'{description} ' + ('significant' if sig else 'INsignificant') + f' (p={p}, {permutations} permutations)')
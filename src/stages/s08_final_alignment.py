@@ -1,55 +1,132 @@
-# Compute an alignment between wn and ox
-import numpy as np
-from sentence_transformers import SentenceTransformer, util
+# Compute an alignment between wn and ox; on reruns only (word, pos) keys whose definitions changed are realigned.
+# With --shards and --shard, only aligns one shard of the words (see src/sharding.py)
+import argparse
+import hashlib
+import os
+import pickle
+import time
+
+from sentence_transformers import SentenceTransformer
+
+from src.alignment_scoring import segment_scores, stack_segments
+from src.columnar_dictionary import load_dictionary
+from src.common import save_pickle, info, warn, open_pickle
+from src.embedding_cache import EmbeddingCache
+from src.global_variables import wn_dictionary_dir, ox_dictionary_dir, full_alignment_file, encode_batch_size, \
+    full_alignment_state_file
+from src.hashing import Hasher, code_digest
+from src.sharding import add_shard_arguments, check_shard_arguments, in_shard, output_file
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--full', action='store_true', help='Realign every key, ignoring the previous alignment')
+add_shard_arguments(parser)
+args = parser.parse_args()
+check_shard_arguments(args)
+
+alignment_file = output_file(full_alignment_file, args)
+alignment_state_file = output_file(full_alignment_state_file, args)
+
+model_name = 'sentence-t5-xxl'
+metric = 'dot_prod'
+run = time.time_ns()  # Recorded against every key this run aligns, so s09 reclusters them
+code = code_digest('src.stages.s08_final_alignment', Hasher({}))  # The previous alignment is only kept for this code
+
+
+def key_digest(wn_senses, ox_senses):
+    # Everything s08 and s09 read for a key, so either only redoes keys where it changed
+    content = ([(defn['id'], defn['definition']) for defn in wn_senses],
+               [(defn['id'], defn['definition'], defn['coarse_lemma_id']) for defn in ox_senses])
+    return hashlib.sha1(pickle.dumps(content, protocol=4)).hexdigest()
 
-from src.common import save_pickle, info, open_pickle, warn
-from src.global_variables import wn_dictionary_file, ox_dictionary_file, full_alignment_file
-
-info('Initialising sentence embedding model')
-
-model = SentenceTransformer('sentence-t5-xxl')
-metric = lambda a, b: util.dot_score(a, b).numpy()
 
 info('Loading dictionaries')
 
-wn_dict = open_pickle(wn_dictionary_file)
-ox_dict = open_pickle(ox_dictionary_file)
-all_items = list(wn_dict.keys())
-
-alignment = {}
-
-info('Aligning...')
-for j, (word, pos), in enumerate(all_items):
-
-    if j % 10 == 0:
-        info(f'On word {j + 1}/{len(all_items)}')
+wn_dict = load_dictionary(wn_dictionary_dir)
+ox_dict = load_dictionary(ox_dictionary_dir)
+all_items = [(word, pos) for (word, pos) in wn_dict.keys() if in_shard(word, args)]
 
-    assert (word, pos) in wn_dict.keys()
+info('Hashing definitions')
+senses = {}  # (word, pos) -> (wn senses, ox senses)
+digests = {}
+for (word, pos) in all_items:
     if (word, pos) not in ox_dict.keys():
         warn(f"{word} ({pos}) not in Oxford keys")
         continue
-
     wn_senses = wn_dict[(word, pos)].values()
-    wn_ids = [defn['id'] for defn in wn_senses]
-    wn_defs = [defn['definition'] for defn in wn_senses]
-
     ox_senses = ox_dict[(word, pos)].values()
-    ox_ids = [defn['id'] for defn in ox_senses]
-    ox_defs = [defn['definition'] for defn in ox_senses]
-
-    similarities = {}
-
-    wn_embeddings = model.encode(wn_defs)
-    ox_embeddings = model.encode(ox_defs)
-    sims = metric(wn_embeddings, ox_embeddings)
-
-    for wn_id, similarity in zip(wn_ids, sims):
-        best = ox_ids[np.argmax(similarity)]
+    senses[(word, pos)] = (wn_senses, ox_senses)
+    digests[(word, pos)] = key_digest(wn_senses, ox_senses)
 
+# The previous alignment is kept for keys whose digest is unchanged
+alignment = {}
+previous = {'digests': {}, 'wn_ids': {}, 'runs': {}}
+if not args.full and os.path.exists(alignment_file) and os.path.exists(alignment_state_file):
+    state = open_pickle(alignment_state_file)
+    if (state['model'], state['metric']) != (model_name, metric):
+        info(f"Previous alignment used {state['model']} ({state['metric']}); realigning everything")
+    elif state.get('code') != code:
+        info('Alignment code changed since the previous alignment; realigning everything')
+    else:
+        alignment = open_pickle(alignment_file)
+        previous = state
+
+aligned_items = [key for key in senses.keys() if previous['digests'].get(key) != digests[key]]
+removed_items = [key for key in previous['digests'].keys() if key not in digests]
+aligned_keys = set(aligned_items)
+info(f'{len(aligned_items)} new or changed keys to align, {len(removed_items)} removed, '
+     f'{len(digests) - len(aligned_items)} unchanged')
+
+for key in removed_items + aligned_items:
+    for wn_id in previous['wn_ids'].get(key, []):
+        del alignment[wn_id]
+
+if len(aligned_items) > 0:
+    info('Initialising sentence embedding model')
+    model = SentenceTransformer(model_name)
+    cache = EmbeddingCache(model_name)
+
+    info('Collecting definitions')
+    all_defs = set()
+    for key in aligned_items:
+        wn_senses, ox_senses = senses[key]
+        all_defs.update(defn['definition'] for defn in wn_senses)
+        all_defs.update(defn['definition'] for defn in ox_senses)
+
+    # Each unique definition is encoded once, in large batches, rather than per word
+    embeddings, def_rows = cache.encode_corpus(model, all_defs, batch_size=encode_batch_size)
+
+    info('Aligning...')
+    wn_ids = []
+    ox_ids = []
+    wn_segments = []
+    ox_segments = []
+    for key in aligned_items:
+        wn_senses, ox_senses = senses[key]
+        wn_ids.extend(defn['id'] for defn in wn_senses)
+        wn_segments.append([def_rows[defn['definition']] for defn in wn_senses])
+        ox_ids.extend(defn['id'] for defn in ox_senses)
+        ox_segments.append([def_rows[defn['definition']] for defn in ox_senses])
+
+    wn_rows, wn_offsets = stack_segments(wn_segments)
+    ox_rows, ox_offsets = stack_segments(ox_segments)
+    best_rows = segment_scores(embeddings[wn_rows], embeddings[ox_rows], wn_offsets, ox_offsets,
+                               metrics=[metric])[metric]
+
+    for wn_id, best_row in zip(wn_ids, best_rows[:, 0]):
         assert wn_id not in alignment.keys()
-        alignment[wn_id] = best
+        alignment[wn_id] = ox_ids[best_row]
+    cache.close()
 
 info('Saving')
-save_pickle(full_alignment_file, alignment)
+save_pickle(alignment_file, alignment)
+save_pickle(alignment_state_file, {
+    'model': model_name,
+    'metric': metric,
+    'code': code,
+    'digests': digests,
+    'wn_ids': {key: [defn['id'] for defn in wn_senses] for key, (wn_senses, _) in senses.items()},
+    # The run that last aligned each key; unlike the digests, it changes with --full or a new model or metric
+    'runs': {key: run if key in aligned_keys else previous.get('runs', {}).get(key) for key in senses.keys()}
+})
 
 info('Done')
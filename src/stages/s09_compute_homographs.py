@@ -1,53 +1,113 @@
+# Cluster the wn senses of each word into homographs by their aligned ox lemmas. With --shards and --shard, only
+# clusters one shard of the words, from the same shard of s08 (see src/sharding.py); shards cannot save fetched lemmas,
+# so they need a compiled etymology graph or --missing_lemmas fail or leaf
+import argparse
+import os
 from collections import defaultdict
 
+from src.columnar_dictionary import load_dictionary
 from src.common import open_pickle, info, save_pickle
-from src.global_variables import full_alignment_file, wn_dictionary_file, ox_dictionary_file, between_pos_pkl_file, \
-    within_pos_pkl_file, raw_pkl_file
-from src.homograph_coarsener_v1 import HomographCoarsenerV1
-
-alignment = open_pickle(full_alignment_file)
-wn_dict = open_pickle(wn_dictionary_file)
-ox_dict = open_pickle(ox_dictionary_file)
-
-hc = HomographCoarsenerV1()
-
+from src.global_variables import full_alignment_file, wn_dictionary_dir, ox_dictionary_dir, between_pos_pkl_file, \
+    within_pos_pkl_file, raw_pkl_file, full_alignment_state_file, homographs_state_file, ox_lemma_info_dir
+from src.etymology_graph import load_coarsener, EtymologyGraph
+from src.homograph_coarsener_v1 import missing_lemma_modes
+from src.hashing import Hasher, code_digest
+from src.mapped_files import directory_signature
+from src.sharding import add_shard_arguments, check_shard_arguments, in_shard, output_file
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--missing_lemmas', choices=missing_lemma_modes, default='fetch',
+                    help='How to handle derivations missing from the lemma info: fetch them all before coarsening, '
+                         'fail, or treat them as leaves without going online')
+parser.add_argument('--full', action='store_true', help='Recompute every word, ignoring the previous clusters')
+parser.add_argument('--workers', type=int, default=1, help='Processes coarsening the lemma groups')
+add_shard_arguments(parser)
+args = parser.parse_args()
+check_shard_arguments(args)
+
+between_pos_file, within_pos_file, raw_file, state_file = [output_file(file, args) for file in [
+    between_pos_pkl_file, within_pos_pkl_file, raw_pkl_file, homographs_state_file]]
+
+alignment = open_pickle(output_file(full_alignment_file, args))
+alignment_state = open_pickle(output_file(full_alignment_state_file, args))
+alignment_digests = alignment_state['digests']
+alignment_runs = alignment_state['runs']
+wn_dict = load_dictionary(wn_dictionary_dir)
+ox_dict = load_dictionary(ox_dictionary_dir)
+
+hc = load_coarsener(args.missing_lemmas)
+if args.shard is not None:
+    # Shards may run at once, so they leave the shared lemma info alone and anything they fetched would be lost
+    assert isinstance(hc, EtymologyGraph) or args.missing_lemmas != 'fetch', \
+        'A shard cannot fetch missing lemmas; compile the etymology graph or pass --missing_lemmas fail or leaf'
+
+
+def name_clusters(lemmas, clusters, prefix):
+    # Lemma -> cluster name, numbering the clusters of this word (and pos) from 1
+    cluster_name_lookup = {}
+    for index, clust in enumerate(set(clusters)):
+        cluster_name_lookup[clust] = f'{prefix}.{index+1}'
+    return {lem: cluster_name_lookup[clust] for lem, clust in zip(lemmas, clusters)}
 
-def build_lemma_dict(ordered_lemmas, word, pos):
-    clusters = hc.coarsen_homographs(ordered_lemmas)
 
-    # Rename clusters
-    all_clusters = set(clusters)
-    cluster_name_lookup = {}
-    for index, clust in enumerate(all_clusters):
-        if pos is None:
-            name = f'{word}.{index+1}'
-        else:
-            name = f'{word}.{pos}.{index+1}'
-        cluster_name_lookup[clust] = name
+class ClusterRegistry:
+    # Cluster names in use in a clustering, so checking a word's new names are unique is a set lookup rather than a
+    # scan of every assigned cluster
 
-    lemma_to_cluster_lookup = {lem: cluster_name_lookup[clust] for lem, clust in zip(ox_lemmas_ordered, clusters)}
+    def __init__(self, clustering):
+        self.names = set(clustering.values())
 
-    return lemma_to_cluster_lookup
+    def add(self, names):
+        for name in names:
+            assert name not in self.names
+        self.names.update(names)
 
 
 words = defaultdict(set)
 for (word, pos) in wn_dict.keys():
-    words[word].add(pos)
+    if in_shard(word, args):
+        words[word].add(pos)
 
 between_pos_homographs = {}
 within_pos_homographs = {}
 raw_homographs = {}
-
-for i, (word, poses) in enumerate(words.items()):
-
-    if i % 100 == 0:
-        info(f'Processing word {i}/{len(words.items())}')
-
-    all_wn_ids = []
-    all_ox_ids = []
-    all_ox_lemmas_lookup = {}
-
-    # Compute within_pos
+word_wn_ids = {}  # word -> its wn ids in the clusterings, so its clusters can be replaced
+
+# Only words with a key whose s08 digest changed, or that s08 realigned, are recomputed, unless the lemma info, the
+# options or the code have changed too
+code = code_digest('src.stages.s09_compute_homographs', Hasher({}))  # Including the coarseners it loads
+signature = (directory_signature(ox_lemma_info_dir), args.missing_lemmas, code)
+outputs = [between_pos_file, within_pos_file, raw_file, state_file]
+state = open_pickle(state_file) if os.path.exists(state_file) else None
+if not args.full and all(os.path.exists(file) for file in outputs) and state['signature'] == signature:
+    between_pos_homographs = open_pickle(between_pos_file)
+    within_pos_homographs = open_pickle(within_pos_file)
+    raw_homographs = open_pickle(raw_file)
+    word_wn_ids = state['word_wn_ids']
+
+    changed_keys = {key for key in set(alignment_digests) | set(state['digests'])
+                    if alignment_digests.get(key) != state['digests'].get(key) or
+                    alignment_runs.get(key) != state.get('runs', {}).get(key)}
+    changed_words = {word for (word, _) in changed_keys} | (set(words) ^ set(word_wn_ids))
+    for word in changed_words:
+        for wn_id in word_wn_ids.pop(word, []):
+            between_pos_homographs.pop(wn_id, None)
+            within_pos_homographs.pop(wn_id, None)
+            raw_homographs.pop(wn_id, None)
+    info(f'Recomputing {len(changed_words)} changed words of {len(words)}')
+else:
+    changed_words = set(words)
+
+words_to_do = [(word, poses) for word, poses in words.items() if word in changed_words]
+hc.prefetch({entry['coarse_lemma_id'] for word, poses in words_to_do for pos in poses
+             for entry in ox_dict[(word, pos)].values()})
+
+# Gather the lemmas aligned to each word, with a lemma group for each pos and one for the whole word
+info(f'Collecting aligned lemmas of {len(words_to_do)} words')
+word_plans = []
+lemma_groups = []
+for word, poses in words_to_do:
+    plan = {'word': word, 'poses': [], 'wn_ids': [], 'ox_ids': [], 'lemmas': {}}
     for pos in poses:
 
         if (word, pos) not in ox_dict.keys():
@@ -55,58 +115,71 @@ for i, (word, poses) in enumerate(words.items()):
 
         wn_ids = list(wn_dict[(word, pos)].keys())
         ox_aligned_ids = [alignment[wn_id] for wn_id in wn_ids]
+        aligned = set(ox_aligned_ids)
 
         # Get possible lemmas
-        ox_entries = ox_dict[(word, pos)]
-        ox_lemmas_filtered = {ox_id: entry['coarse_lemma_id'] for ox_id, entry in ox_entries.items()
-                              if ox_id in ox_aligned_ids}
-
-        # Save this info for the between_pos compute
-        all_wn_ids.extend(wn_ids)
-        all_ox_ids.extend(ox_aligned_ids)
+        ox_lemmas_filtered = {ox_id: entry['coarse_lemma_id'] for ox_id, entry in ox_dict[(word, pos)].items()
+                              if ox_id in aligned}
         for ox_id, lemma in ox_lemmas_filtered.items():
-            assert ox_id not in all_ox_lemmas_lookup.keys()
-            all_ox_lemmas_lookup[ox_id] = lemma
+            assert ox_id not in plan['lemmas'].keys()
+            plan['lemmas'][ox_id] = lemma
+
+        plan['wn_ids'].extend(wn_ids)
+        plan['ox_ids'].extend(ox_aligned_ids)
+        plan['poses'].append((pos, wn_ids, ox_aligned_ids, list(set(ox_lemmas_filtered.values()))))
+        lemma_groups.append(plan['poses'][-1][3])
+    lemma_groups.append(list(plan['lemmas'].values()))
+    word_plans.append(plan)
+
+# Coarsening a pos's lemmas alone can differ from coarsening them with the word's other lemmas, so every group is
+# coarsened, but all at once: identical groups (e.g. of single-pos words) are coarsened once, across the workers
+group_clusters = iter(hc.coarsen_many(lemma_groups, workers=args.workers))
+
+within_pos_registry = ClusterRegistry(within_pos_homographs)
+between_pos_registry = ClusterRegistry(between_pos_homographs)
+for i, plan in enumerate(word_plans):
+    word = plan['word']
 
-        # Get homograph clusters
-        ox_lemmas_ordered = list(set(ox_lemmas_filtered.values()))
-        ox_lemma_to_cluster = build_lemma_dict(ox_lemmas_ordered, word, pos)
+    if i % 1000 == 0:
+        info(f'Assigning word {i}/{len(word_plans)}')
 
-        # Check no clusters with these names exist
-        for cluster in set(ox_lemma_to_cluster.values()):
-            assert cluster not in within_pos_homographs.values()
+    # Within pos and raw clusters, taking the coarsened groups in the order they were gathered
+    for pos, wn_ids, ox_aligned_ids, lemmas in plan['poses']:
+        ox_lemma_to_cluster = name_clusters(lemmas, next(group_clusters), f'{word}.{pos}')
+        within_pos_registry.add(set(ox_lemma_to_cluster.values()))
 
-        # Add to clustering
         for wn_id, ox_id in zip(wn_ids, ox_aligned_ids):
             assert wn_id not in within_pos_homographs.keys()
             assert wn_id not in raw_homographs.keys()
 
-            ox_lemma = ox_lemmas_filtered[ox_id]
-            cluster = ox_lemma_to_cluster[ox_lemma]
-
-            within_pos_homographs[wn_id] = cluster
+            ox_lemma = plan['lemmas'][ox_id]
+            within_pos_homographs[wn_id] = ox_lemma_to_cluster[ox_lemma]
             raw_homographs[wn_id] = ox_lemma
 
-    # Compute between_pos
-    ox_lemmas_ordered = list(all_ox_lemmas_lookup.values())
-    ox_lemma_to_cluster = build_lemma_dict(ox_lemmas_ordered, word, None)
-
-    # Check no clusters with these names exist
-    for cluster in set(ox_lemma_to_cluster.values()):
-        assert cluster not in between_pos_homographs.values()
+    # Between pos clusters
+    ox_lemma_to_cluster = name_clusters(list(plan['lemmas'].values()), next(group_clusters), word)
+    between_pos_registry.add(set(ox_lemma_to_cluster.values()))
 
-    # Add to clustering
-    for wn_id, ox_id in zip(all_wn_ids, all_ox_ids):
+    for wn_id, ox_id in zip(plan['wn_ids'], plan['ox_ids']):
         assert wn_id not in between_pos_homographs.keys()
+        between_pos_homographs[wn_id] = ox_lemma_to_cluster[plan['lemmas'][ox_id]]
 
-        ox_lemma = all_ox_lemmas_lookup[ox_id]
-        cluster = ox_lemma_to_cluster[ox_lemma]
-
-        between_pos_homographs[wn_id] = cluster
+    word_wn_ids[word] = plan['wn_ids']
 
 info('Saving')
-save_pickle(between_pos_pkl_file, between_pos_homographs)
-save_pickle(within_pos_pkl_file, within_pos_homographs)
-save_pickle(raw_pkl_file, raw_homographs)
-
-hc.save()
+save_pickle(between_pos_file, between_pos_homographs)
+save_pickle(within_pos_file, within_pos_homographs)
+save_pickle(raw_file, raw_homographs)
+
+if args.shard is None:
+    hc.save()
+else:
+    # Shards may run at once, so leave the shared memo alone
+    info('Not saving the coarsening memo from a shard')
+# Taken after saving, as lemmas fetched while coarsening rewrite the lemma info
+save_pickle(state_file, {
+    'signature': (directory_signature(ox_lemma_info_dir), args.missing_lemmas, code),
+    'digests': alignment_digests,
+    'runs': alignment_runs,
+    'word_wn_ids': word_wn_ids
+})
@@ -1,118 +1,140 @@
+# Count the words with homographs under each clustering (raw, within pos and between pos), in one pass over words.
+# Prints the LaTeX tables and saves the counts as JSON and CSV
+import argparse
+import json
+import os
 from collections import defaultdict
-from nltk.corpus import wordnet as wn
 
-from src.common import open_pickle, info
-from src.global_variables import between_pos_pkl_file, within_pos_pkl_file, wn_dictionary_file, ox_dictionary_file, \
-    raw_pkl_file
-from src.homograph_coarsener_v1 import HomographCoarsenerV1
+from src.columnar_dictionary import load_dictionary
+from src.common import open_pickle, info, warn, save_csv
+from src.global_variables import between_pos_pkl_file, within_pos_pkl_file, wn_dictionary_dir, ox_dictionary_dir, \
+    raw_pkl_file, wn_synset_counts_file, analysis_json_file, analysis_csv_file
+from src.etymology_graph import load_coarsener
+from src.homograph_coarsener_v1 import missing_lemma_modes
 
-wn_dict = open_pickle(wn_dictionary_file)
-ox_dict = open_pickle(ox_dictionary_file)
+parser = argparse.ArgumentParser()
+parser.add_argument('--missing_lemmas', choices=missing_lemma_modes, default='fetch',
+                    help='How to handle derivations missing from the lemma info: fetch them all before coarsening, '
+                         'fail, or treat them as leaves without going online')
+args = parser.parse_args()
 
-hc = HomographCoarsenerV1()
+wn_dict = load_dictionary(wn_dictionary_dir)
+ox_dict = load_dictionary(ox_dictionary_dir)
+
+views = [('raw', raw_pkl_file), ('within', within_pos_pkl_file), ('between', between_pos_pkl_file)]
+cluster_dicts = {name: open_pickle(cluster_dict_file) for name, cluster_dict_file in views}
 
 words = defaultdict(set)
 for (word, pos) in wn_dict.keys():
     words[word].add(pos)
 
-for name, cluster_dict_file in [('raw', raw_pkl_file), ('within', within_pos_pkl_file), ('between', between_pos_pkl_file)]:
-
-    info(f'Analysing {name}')
-
-    word_stats_by_pos = defaultdict(set)
-    homographs = set()
-
-    cluster_dict = open_pickle(cluster_dict_file)
-
-    for word, poses in words.items():
-
-        if name == 'between':
-            ox_lemmas = set()
-            pos_to_lemmas = {}
-            for pos in poses:
-                if (word, pos) in ox_dict.keys():
-                    pos_lemmas = {ox_data['coarse_lemma_id'] for ox_data in ox_dict[(word, pos)].values()}
-                    ox_lemmas = ox_lemmas.union(pos_lemmas)
-                    pos_to_lemmas[pos] = pos_lemmas
-
-            if len(ox_lemmas) > 0:  # Skips words where all pos missing
-                ox_lemmas = list(ox_lemmas)
-                if len(ox_lemmas) > 1:
-                    ox_coarse_homographs = hc.coarsen_homographs(ox_lemmas)
-                    ox_lemma_map = {lem: clust for lem, clust in zip(ox_lemmas, ox_coarse_homographs)}
-                else:
-                    ox_lemma_map = {ox_lemmas[0]: ox_lemmas[0]}
-
-        elif name == 'raw':
-            ox_lemmas = set()
-            pos_to_lemmas = {}
-            for pos in poses:
-                if (word, pos) in ox_dict.keys():
-                    pos_lemmas = {ox_data['coarse_lemma_id'] for ox_data in ox_dict[(word, pos)].values()}
-                    ox_lemmas = ox_lemmas.union(pos_lemmas)
-                    pos_to_lemmas[pos] = pos_lemmas
-            ox_lemma_map = {}
-            for lemma in ox_lemmas:
-                ox_lemma_map[lemma] = lemma
-
-        for pos in poses:
-
-            entries = wn_dict[(word, pos)]
+if os.path.exists(wn_synset_counts_file):
+    synset_counts = open_pickle(wn_synset_counts_file)
+else:
+    warn(f'No {wn_synset_counts_file}; rerun s01 to make it. Counting synsets with NLTK instead')
+    from nltk.corpus import wordnet as wn
+    synset_counts = {word: len(wn.synsets(word)) for word in words.keys()}
+
+# The lemmas of each (word, pos) in ox_dict, and of each word over all its pos, shared by every view
+info('Collecting lemmas')
+pos_lemmas = {}
+word_lemmas = {}
+for word, poses in words.items():
+    lemmas = set()
+    for pos in poses:
+        if (word, pos) in ox_dict.keys():
+            pos_lemmas[(word, pos)] = sorted({ox_data['coarse_lemma_id'] for ox_data in ox_dict[(word, pos)].values()})
+            lemmas.update(pos_lemmas[(word, pos)])
+    word_lemmas[word] = sorted(lemmas)
+
+# Within pos coarsens each pos's lemmas alone, between pos the word's lemmas together; coarsened all at once, so
+# lemmas are resolved once and groups shared by both are coarsened once
+groups = [lemmas for lemmas in list(pos_lemmas.values()) + list(word_lemmas.values()) if len(lemmas) > 1]
+hc = load_coarsener(args.missing_lemmas)
+hc.prefetch({lemma for lemmas in groups for lemma in lemmas})
+coarse_clusters = {tuple(lemmas): dict(zip(lemmas, clusters))
+                   for lemmas, clusters in zip(groups, hc.coarsen_many(groups))}
+
+
+def potential_homographs(word, pos):
+    # Whether the (word, pos)'s lemmas fall into more than one cluster, under each view
+    lemmas = pos_lemmas[(word, pos)]
+    if len(lemmas) <= 1:
+        return {'raw': False, 'within': False, 'between': False}
+    word_clusters = coarse_clusters[tuple(word_lemmas[word])]
+    return {'raw': True,
+            'within': len(set(coarse_clusters[tuple(lemmas)].values())) > 1,
+            'between': len({word_clusters[lemma] for lemma in lemmas}) > 1}
+
+
+info('Analysing')
+word_stats_by_pos = {name: defaultdict(set) for name, _ in views}
+homographs = {name: set() for name, _ in views}
+for word, poses in words.items():
+    for pos in poses:
 
-            word_stats_by_pos[pos + ':total'].add(word)
+        for name, _ in views:
+            word_stats_by_pos[name][pos + ':total'].add(word)
 
-            if (word, pos) not in ox_dict.keys():
-                word_stats_by_pos[pos+':missing'].add(word)
-                continue
+        if (word, pos) not in ox_dict.keys():
+            for name, _ in views:
+                word_stats_by_pos[name][pos + ':missing'].add(word)
+            continue
 
-            wn_ids = entries.keys()
-            clusters = set()
-            for wn_id in wn_ids:
-                clusters.add(cluster_dict[wn_id])
+        wn_ids = wn_dict[(word, pos)].keys()
+        potential = potential_homographs(word, pos)
+        for name, _ in views:
+            clusters = {cluster_dicts[name][wn_id] for wn_id in wn_ids}
 
             assert len(clusters) > 0
             if len(clusters) > 1:
-                word_stats_by_pos[pos+':homographs'].add(word)
-                homographs.add((word,pos))
-
-            # Get extra stats
-            if name == 'within':
-                ox_lemmas = list({ox_data['coarse_lemma_id'] for ox_data in ox_dict[(word, pos)].values()})
-                if len(ox_lemmas) > 1:
-                    ox_coarse_homographs = set(hc.coarsen_homographs(ox_lemmas))
-                    if len(ox_coarse_homographs) > 1:
-                        word_stats_by_pos[pos + ':potential_homographs'].add(word)
-            else:
-                assert name == 'between' or name == 'raw'
-                pos_lemmas = pos_to_lemmas[pos]
-                coarse_clusters = set()
-                for lemma in pos_lemmas:
-                    coarse_clusters.add(ox_lemma_map[lemma])
-                if len(coarse_clusters) > 1:
-                    word_stats_by_pos[pos + ':potential_homographs'].add(word)
-
-    poses = ['noun', 'verb', 'adj', 'adv']  # , sum, total
-    codes = ['total', 'missing', 'potential_homographs', 'homographs']
+                word_stats_by_pos[name][pos + ':homographs'].add(word)
+                homographs[name].add((word, pos))
+
+            if potential[name]:
+                word_stats_by_pos[name][pos + ':potential_homographs'].add(word)
+
+poses = ['noun', 'verb', 'adj', 'adv']  # , sum, total
+codes = ['total', 'missing', 'potential_homographs', 'homographs']
+
+analysis = {}
+rows = []
+for name, _ in views:
+
+    info(f'Results for {name}')
+    stats = word_stats_by_pos[name]
 
     print('pos & ' + ' & '.join(codes) + " \\\\")
     for pos in poses:
-        output = pos + ' & ' + " & ".join(['$'+str(len(word_stats_by_pos[f'{pos}:{code}']))+'$' for code in codes]) + " \\\\"
-        # output += " & $" + str(sum([len(word_stats_by_pos[f'{pos}:{code}']) for pos in poses])) + '$'
+        output = pos + ' & ' + " & ".join(['$'+str(len(stats[f'{pos}:{code}']))+'$' for code in codes]) + " \\\\"
         print(output)
     total = []
     any = []
     for code in codes:
         all_words = set()
         for pos in poses:
-            all_words = all_words.union(word_stats_by_pos[f'{pos}:{code}'])
+            all_words = all_words.union(stats[f'{pos}:{code}'])
         any.append(len(all_words))
-        total.append(sum([len(word_stats_by_pos[f'{pos}:{code}']) for pos in poses]))
+        total.append(sum([len(stats[f'{pos}:{code}']) for pos in poses]))
     print("total & " + " & ".join(['$' + str(stat) +'$' for stat in total]) + " \\\\")
     print("any & " + " & ".join(['$' + str(stat) +'$' for stat in any]) + " \\\\")
-    print(', '.join(sorted(list({'\\word{' + word + '}' for (word, _) in homographs}))))
-    print({word for (word, _) in homographs})
-
-    print(sum([len(wn.synsets(w)) for w in {word for (word, _) in homographs}]))
+    homograph_words = {word for (word, _) in homographs[name]}
+    print(', '.join(sorted(list({'\\word{' + word + '}' for word in homograph_words}))))
+    print(homograph_words)
+
+    homograph_synsets = sum([synset_counts[w] for w in homograph_words])
+    print(homograph_synsets)
+
+    counts = {pos: {code: len(stats[f'{pos}:{code}']) for code in codes} for pos in poses}
+    counts['total'] = dict(zip(codes, total))
+    counts['any'] = dict(zip(codes, any))
+    analysis[name] = {'counts': counts, 'homographs': sorted(homograph_words), 'homograph_synsets': homograph_synsets}
+    rows.extend({'view': name, 'pos': pos, **pos_counts} for pos, pos_counts in counts.items())
+
+info('Saving')
+with open(analysis_json_file, 'w') as fp:
+    json.dump(analysis, fp, indent=2)
+save_csv(analysis_csv_file, rows)
 
 info('Done')
 hc.save()